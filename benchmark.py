@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Measures how fast slowmovie.py renders frames without an e-ink display attached.
+# Each mode plays the bundled test video and some synthetic clips against a mock
+# display, in its own process so peak memory use can be compared between modes.
+# The start modes time how long a freshly started process takes to show its first
+# frame, with empty caches (cold) or after a previous run (warm, as after a power cut).
+# They load the mock display through a stub omni_epd package, the way a real driver is
+# loaded, so the driver cache and loading in the background are timed too.
+#
+#   python3 benchmark.py
+#   python3 benchmark.py --modes sequential random --refreshes 50 --json before.json
+#   python3 benchmark.py --modes cold-start warm-start
+
+import os
+import sys
+import time
+import json
+import resource
+import tempfile
+import argparse
+import subprocess
+
+# Player arguments for each benchmarked mode
+modes = {
+    "sequential": [],
+    "random": ["--random-frames"],
+    "subtitle": ["--subtitles"],
+    "timecode": ["--timecode"],
+    "fullscreen": ["--fullscreen"],
+    "cold-start": [],
+    "warm-start": []}
+# Modes whose first refresh is timed from when the process was started
+startModes = {"cold-start", "warm-start"}
+
+# Synthetic clips: name, FFmpeg test source, encoder options
+clips = [
+    ("synthetic-1080p.mp4", "testsrc2=size=1920x1080:rate=30:duration=20", {"vcodec": "libx264", "g": 250, "pix_fmt": "yuv420p"}),
+    ("synthetic-anamorphic.mkv", "testsrc2=size=720x576:rate=25:duration=20,setsar=64/45", {"vcodec": "mpeg4", "q:v": 5})]
+
+
+# Stands in for an omni-epd display: keeps the time of every refresh, and saves the
+# frames it's sent if `saveDir` is given
+class MockDisplay:
+    def __init__(self, width=800, height=480, mode="bw", saveDir=None):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.saveDir = saveDir
+        self.refreshes = []
+
+    def prepare(self):
+        pass
+
+    def display(self, image):
+        self.refreshes.append(time.perf_counter())
+        if self.saveDir:
+            image.save(os.path.join(self.saveDir, f"{len(self.refreshes):04d}.png"))
+
+    def sleep(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Stub omni_epd package for the start modes, which loads a MockDisplay set up by the
+# BENCHMARK_DISPLAY environment variable, after waiting to stand in for a driver's setup
+stubPackage = {
+    "__init__.py": """
+class EPDNotFoundError(Exception):
+    pass
+""",
+    "displayfactory.py": """
+import os
+import json
+import time
+from benchmark import MockDisplay
+
+# Every display loaded, for the benchmark to read its refresh times from
+loaded = []
+
+
+def load_display_driver(name):
+    settings = json.loads(os.environ["BENCHMARK_DISPLAY"])
+    time.sleep(settings.pop("delay"))
+    loaded.append(MockDisplay(**settings))
+    return loaded[-1]
+
+
+def list_supported_displays():
+    return ["benchmark.mock"]
+"""}
+
+
+# Write the stub omni_epd package into `directory`
+def write_stub(directory):
+    os.makedirs(os.path.join(directory, "omni_epd"), exist_ok=True)
+    for name, source in stubPackage.items():
+        with open(os.path.join(directory, "omni_epd", name), "w") as file:
+            file.write(source.lstrip())
+
+
+# Write an SRT file with a cue every few seconds, for the subtitle mode
+def write_subtitles(filename, duration):
+    with open(filename, "w") as srt:
+        for i, start in enumerate(range(0, int(duration), 4)):
+            end = start + 3
+            srt.write(f"{i + 1}\n00:00:{start:02d},000 --> 00:00:{end:02d},000\nSubtitle number {i + 1}\nwith a second line\n\n")
+
+
+# Collect the videos to benchmark in `viddir`, generating the synthetic clips and a subtitle file for each
+def make_library(viddir, sources, synthetic=True):
+    import ffmpeg
+    os.makedirs(viddir, exist_ok=True)
+    for source in sources:
+        os.symlink(os.path.abspath(source), os.path.join(viddir, os.path.basename(source)))
+    if synthetic:
+        for name, source, options in clips:
+            print(f"Generating {name}...", file=sys.stderr)
+            ffmpeg.input(source, f="lavfi").output(os.path.join(viddir, name), an=None, **options).run(quiet=True)
+    videos = sorted(os.path.join(viddir, video) for video in os.listdir(viddir))
+    for video in videos:
+        duration = float(ffmpeg.probe(video)["format"]["duration"])
+        write_subtitles(os.path.splitext(video)[0] + ".srt", duration)
+    return videos
+
+
+# Play `video` in `mode` for a number of refreshes in this process, and return its measurements.
+# `launched` is how long ago the process was started, for the start modes, which load the display
+# through the stub omni_epd package instead of being given `display`
+def run_mode(mode, video, refreshes, playerArgs, display, launched=0):
+    importStart = time.perf_counter()
+    import slowmovie
+    importTime = time.perf_counter() - importStart
+
+    argv = ["--file", video, "--delay", "0", "--loglevel", "WARNING", "--stats-window", str(refreshes + 1), *modes[mode], *playerArgs]
+    start = time.perf_counter()
+    if mode in startModes:
+        player, = slowmovie.main(argv + ["--epd", "benchmark.mock"], refreshes=refreshes)
+        from omni_epd import displayfactory
+        display = displayfactory.loaded[-1]
+    else:
+        player, = slowmovie.main(argv, display=display, refreshes=refreshes)
+    elapsed = time.perf_counter() - start
+
+    import numpy
+    first = display.refreshes[0] - start if display.refreshes else None
+    if first is not None and mode in startModes:
+        first += launched + importTime
+
+    times = display.refreshes
+    stages = {}
+    for name, samples in player.timer.samples.items():
+        # The first refresh is left out, it includes probing the video and starting FFmpeg
+        samples = list(samples)[1:] or list(samples)
+        p50, p95 = numpy.percentile(samples, [50, 95])
+        stages[name] = {"p50": p50, "p95": p95, "max": max(samples)}
+    return {
+        "video": os.path.basename(video),
+        "mode": mode,
+        "refreshes": len(times),
+        "elapsed": elapsed,
+        "first": first,
+        "import": importTime,
+        "fps": (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else None,
+        "stages": stages,
+        # ru_maxrss is in kilobytes on Linux. FFmpeg's processes count as children once they've exited
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "ffmpegRss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024}
+
+
+# Run one mode in a fresh process and working directory, so no caches or memory carry over
+# (except that warm-start runs once beforehand to fill the caches)
+def spawn_mode(mode, video, options, workdir):
+    if mode == "warm-start":
+        spawn_mode("cold-start", video, options, workdir)
+    command = [sys.executable, os.path.realpath(__file__), "--child", mode, video,
+               "--refreshes", str(options.refreshes), "--width", str(options.width), "--height", str(options.height), "--display-mode", options.display_mode]
+    if options.save_images:
+        saveDir = os.path.join(os.path.abspath(options.save_images), f"{os.path.splitext(os.path.basename(video))[0]}-{mode}")
+        os.makedirs(saveDir, exist_ok=True)
+        command += ["--save-images", saveDir]
+    if options.player_args:
+        command.append(f"--player-args={options.player_args}")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.realpath(__file__)), os.environ.get("PYTHONPATH")])))
+    if mode in startModes:
+        command.append(f"--driver-delay={options.driver_delay}")
+        write_stub(os.path.join(workdir, "stubs"))
+        env["PYTHONPATH"] = os.pathsep.join([os.path.join(workdir, "stubs"), env["PYTHONPATH"]])
+    command.append(f"--launched={time.time()}")
+    result = subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.PIPE)
+    if result.returncode:
+        print(f"{mode} on {os.path.basename(video)} failed with exit code {result.returncode}", file=sys.stderr)
+        return None
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def format_stage(stage):
+    if not stage:
+        return "-"
+    return f"{stage['p50'] * 1000:.0f}/{stage['p95'] * 1000:.0f}/{stage['max'] * 1000:.0f}"
+
+
+def print_report(results):
+    stageNames = ["decode", "overlay", "process", "display"]
+    print(f"{'video':<26} {'mode':<11} {'fps':>7} {'first s':>8} {'import s':>8} " + " ".join(f"{name + ' ms':>14}" for name in stageNames) + f" {'rss MB':>7} {'ffmpeg MB':>9}")
+    for result in results:
+        fps = f"{result['fps']:.2f}" if result["fps"] else "-"
+        first = f"{result['first']:.2f}" if result["first"] is not None else "-"
+        stages = " ".join(f"{format_stage(result['stages'].get(name)):>14}" for name in stageNames)
+        print(f"{result['video'][:26]:<26} {result['mode']:<11} {fps:>7} {first:>8} {result['import']:>8.2f} {stages} {result['rss'] / 2**20:>7.1f} {result['ffmpegRss'] / 2**20:>9.1f}")
+    print("Stage times are p50/p95/max over all refreshes after the first. For the start modes, first is timed from starting Python.")
+
+
+parser = argparse.ArgumentParser(description="Benchmark slowmovie.py's frame pipeline against a mock display")
+parser.add_argument("-m", "--modes", nargs="+", default=list(modes), choices=modes.keys(), help="modes to benchmark (default: all)")
+parser.add_argument("-n", "--refreshes", default=20, type=int, help="refreshes to time in each run (default: %(default)s)")
+parser.add_argument("-v", "--videos", nargs="+", help="videos to play; otherwise Videos/test.mp4 and synthetic clips")
+parser.add_argument("--no-synthetic", action="store_true", help="don't generate synthetic clips")
+parser.add_argument("--width", default=800, type=int, help="width of the mock display (default: %(default)s)")
+parser.add_argument("--height", default=480, type=int, help="height of the mock display (default: %(default)s)")
+parser.add_argument("--display-mode", default="bw", help="omni-epd mode of the mock display (default: %(default)s)")
+parser.add_argument("--driver-delay", default=0, type=float, metavar="SECONDS", help="for the start modes, how long loading the display driver takes (default: %(default)s)")
+parser.add_argument("--player-args", help="extra slowmovie.py arguments for every run, as one quoted string")
+parser.add_argument("--save-images", metavar="DIR", help="save every frame sent to the mock display under DIR")
+parser.add_argument("--json", metavar="FILE", help="also write the results to FILE, to compare runs")
+parser.add_argument("--child", nargs=2, metavar=("MODE", "VIDEO"), help=argparse.SUPPRESS)
+parser.add_argument("--launched", type=float, help=argparse.SUPPRESS)
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    playerArgs = options.player_args.split() if options.player_args else []
+
+    if options.child:
+        # Running a single mode for the parent process, which reads the result from stdout
+        mode, video = options.child
+        display = MockDisplay(options.width, options.height, options.display_mode, options.save_images)
+        os.environ["BENCHMARK_DISPLAY"] = json.dumps({"width": options.width, "height": options.height, "mode": options.display_mode, "saveDir": options.save_images, "delay": options.driver_delay})
+        result = run_mode(mode, video, options.refreshes, playerArgs, display, time.time() - options.launched if options.launched else 0)
+        print(json.dumps(result))
+        sys.exit()
+
+    with tempfile.TemporaryDirectory(prefix="slowmovie-benchmark-") as tempdir:
+        if options.videos:
+            videos = make_library(os.path.join(tempdir, "Videos"), options.videos, False)
+        else:
+            testVideo = os.path.join(os.path.dirname(os.path.realpath(__file__)), "Videos", "test.mp4")
+            videos = make_library(os.path.join(tempdir, "Videos"), [testVideo], not options.no_synthetic)
+
+        results = []
+        for video in videos:
+            for mode in options.modes:
+                print(f"Running {mode} on {os.path.basename(video)}...", file=sys.stderr)
+                workdir = tempfile.mkdtemp(dir=tempdir)
+                result = spawn_mode(mode, video, options, workdir)
+                if result:
+                    results.append(result)
+
+    print_report(results)
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump(results, file, indent=2)
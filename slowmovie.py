@@ -15,79 +15,1726 @@ import time
 import sys
 import random
 import signal
+import asyncio
 import logging
 import glob
+import json
+import bisect
+import re
+import itertools
+import collections
+import contextlib
+import functools
+import subprocess
+import hashlib
+import concurrent.futures
+import struct
+import threading
 import ffmpeg
+import numpy
 import configargparse
-from PIL import Image, ImageEnhance
-from fractions import Fraction
-from omni_epd import displayfactory, EPDNotFoundError
+from concurrent.futures import ThreadPoolExecutor, wait
+from PIL import Image, ImageColor
+# Modules only some features use (omni_epd, configparser, ctypes, mmap, fractions and PIL's text
+# drawing) are imported where they're needed, so they don't hold up the first frame
 
 
 # Compatible video file-extensions
 fileTypes = [".avi", ".mp4", ".m4v", ".mkv", ".mov"]
 subtitle_fileTypes = [".srt", ".ssa", ".ass"]
 
-
-# Move to the directory where this code is
-os.chdir(os.path.dirname(os.path.realpath(__file__)))
-
-
-# Handle when the program is killed and exit gracefully
-def exithandler(signum, frame):
-    logger.info("Exiting Program")
-    if args.clear:
-        epd.prepare()
-        epd.clear()
-    try:
-        epd.close()
-    finally:
-        sys.exit()
-
-
-# Add hooks for interrupt signal
-signal.signal(signal.SIGTERM, exithandler)
-signal.signal(signal.SIGINT, exithandler)
+# Hardware decoders to try for each codec, in order of preference. V4L2 M2M is the decoder
+# interface on current Raspberry Pi OS, MMAL on older (Buster and earlier) releases
+hardwareDecoders = {
+    "h264": ["h264_v4l2m2m", "h264_mmal"],
+    "hevc": ["hevc_v4l2m2m"],
+    "mpeg2video": ["mpeg2_v4l2m2m", "mpeg2_mmal"],
+    "mpeg4": ["mpeg4_v4l2m2m", "mpeg4_mmal"],
+    "vc1": ["vc1_v4l2m2m", "vc1_mmal"],
+    "vp8": ["vp8_v4l2m2m"],
+    "vp9": ["vp9_v4l2m2m"]}
+
+# Subtitle style, in proportion to the display height: the same as FFmpeg's default for SRT files
+subtitleSize = 16 / 288
+subtitleOutline = 1 / 288
+subtitleMargin = 10 / 288
+# Number of rendered subtitle cues to keep
+textCacheSize = 32
+# Timecode style, the same as FFmpeg's drawtext filter used to draw it: font size and outline in pixels
+timecodeSize = 24
+timecodeOutline = 1
+
+# SRT cue: start and end times, then the text up to a blank line
+srtCue = re.compile(r"(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)[^\n]*\n(.*?)(?:\n[ \t]*\n|\Z)", re.S)
+# Formatting tags, which aren't drawn: <i>...</i> in SRT, {\an8} etc. in SSA/ASS
+subtitleTags = re.compile(r"<[^>]*>|\{[^}]*\}")
+
+# Codecs whose FFmpeg decoders can decode at a half, quarter or eighth of the resolution (lowres)
+lowresCodecs = {"mjpeg", "mpeg1video", "mpeg2video", "mpeg4", "h263"}
+# Codecs whose decoders can skip their deblocking filter (skip_loop_filter)
+deblockingCodecs = {"h264", "hevc"}
+
+# How often to check the videos directory for changes, in seconds, where inotify isn't available
+libraryPollInterval = 60
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+# Events that change which videos there are: a file finished being written, created as a link or
+# moved in, removed or moved out, or a directory created or removed
+inotifyMask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# omni-epd settings (from its ini files' [Display] and [Image Enhancements] sections) with the values that leave images as they are
+omniNeutralSettings = {"rotate": "0", "flip_horizontal": "false", "flip_vertical": "false", "dither": "none", "contrast": "1", "brightness": "1", "sharpness": "1"}
+
+# Size and mode each display driver had when it was last loaded
+displayCacheFile = os.path.join("progress", "displays.json")
+
+# Where --optimize puts its copies of videos, and its list of them
+optimizedDir = "optimized"
+optimizedManifest = os.path.join(optimizedDir, "manifest.json")
+
+# Compact the progress journal once it has this many times more lines than there are videos in it
+journalSlack = 100
+
+# Bumped when probe_video returns new fields, so older cached probe results are refreshed
+probeVersion = 3
+
+# Number of gray levels each omni-epd display mode can show. Other modes are treated as color
+displayLevels = {"bw": 2, "gray4": 4, "gray16": 16}
+
+# 8x8 ordered dithering matrix
+bayerMatrix = numpy.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21]])
+
+# Pixel formats frames can be extracted in: FFmpeg pixel format, PIL mode, bits per pixel
+pixelFormats = {
+    "rgb": ("rgb24", "RGB", 24),
+    "gray": ("gray", "L", 8),
+    "mono": ("monob", "1", 1)}
 
 
 def clamp(n, smallest, largest):
     return max(smallest, min(n, largest))
 
 
-def generate_frame(in_filename, out_filename, time):
-    (
-        ffmpeg
-        .input(in_filename, ss=time)
-        .filter("scale", "iw*sar", "ih")
-        .fullscreen_filter()
-        .filter("scale", width, height, force_original_aspect_ratio=1)
-        .filter("pad", width, height, -1, -1)
-        .overlay_filter()
-        .output(out_filename, vframes=1, copyts=None)
-        .overwrite_output()
-        .run(capture_stdout=True, capture_stderr=True)
-    )
-
-
-def overlay_filter(self):
-    if args.subtitles and videoInfo["subtitle_file"]:
-        return self.filter("subtitles", videoInfo["subtitle_file"])
-    elif args.timecode:
-        return self.drawtext(escape_text=False, text="%{pts:hms}", fontcolor="white", fontsize=24, x="(w-text_w)/2", y="h-(text_h*2)", bordercolor="black", borderw=1)
-    return self
+# Fill `buffer` with one raw frame from an FFmpeg pipe. Returns False if the pipe ended first
+def read_frame(pipe, buffer):
+    view = memoryview(buffer)
+    while view:
+        count = pipe.readinto(view)
+        if not count:
+            return False
+        view = view[count:]
+    return True
+
+
+# Keeps one FFmpeg process open per video and reads frames from it in sequence, so
+# sequential playback doesn't restart FFmpeg, re-open the file, seek and rebuild the
+# filter graph on every refresh
+class FrameDecoder:
+    # Decoding up to this many frames forward is assumed to be cheaper than seeking,
+    # which has to decode from the previous keyframe anyway
+    maxForward = 250
+    # Roughly how many frames could be decoded in the time it takes to restart FFmpeg
+    seekCost = 24
+
+    def __init__(self, player, filename, info):
+        self.player = player
+        self.filename = filename
+        self.info = info
+        self.process = None
+        self.position = None
+        self.step = None
+        self.scratch = bytearray(player.frame_size())
+
+    # Return frame number `frame` as a PIL image, where the next frame is expected to be `frame + step`
+    def read(self, frame, step):
+        if self.needs_seek(frame, step):
+            self.open(frame, step)
+
+        while True:
+            # Frames before the one we want are read into a scratch buffer and thrown away
+            self.position += step
+            buffer = bytearray(self.player.frame_size()) if self.position > frame else self.scratch
+            if not read_frame(self.process.stdout, buffer):
+                # FFmpeg ran out of frames (e.g. an estimated frame count was too high), or failed
+                failed = self.process.wait() != 0
+                self.close()
+                if failed and self.player.decoder_failed(self.filename):
+                    return self.read(frame, step)
+                return None
+            if self.position > frame:
+                return self.player.frame_image(buffer)
+
+    # Whether it's quicker to restart at `frame` than to keep decoding forward to it
+    def needs_seek(self, frame, step):
+        if not self.process or step != self.step:
+            return True
+        distance = frame - self.position
+        if distance < 0 or distance % step:
+            return True
+        # FFmpeg has only decoded up to the last frame it output
+        lastFrame = self.position - step
+        keyframes = self.info["keyframes"]
+        if keyframes:
+            # Seeking decodes from the last keyframe before `frame`, so it only helps if that's far enough past where we are
+            keyframe = self.player.frame_at(self.info, keyframe_before(keyframes, self.player.frame_seconds(self.info, frame)))
+            return keyframe - lastFrame > self.seekCost
+        return frame - lastFrame > self.maxForward
+
+    # Start a new FFmpeg process at `frame`, outputting every `step`th frame
+    def open(self, frame, step):
+        self.close()
+        self.player.logger.debug(f"Starting decoder for '{os.path.basename(self.filename)}' at frame {frame}")
+        stream = (
+            self.player
+            .input_stream(self.filename, self.info, ss=self.player.frame_seek(self.info, frame))
+            .filter("framestep", step)
+        )
+        self.process = self.player.frame_output(self.player.frame_filters(stream, self.filename, self.info)).run_async(pipe_stdout=True)
+        self.position = frame
+        self.step = step
+
+    def close(self):
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+
+# Pack a gray image into 2 bits per pixel, 4 pixels per byte
+def pack_gray4(pil_im):
+    width, height = pil_im.size
+    pixels = (numpy.asarray(pil_im, dtype=numpy.uint16) * 3 + 127) // 255
+    pixels = numpy.pad(pixels, ((0, 0), (0, -width % 4))).reshape(height, -1, 4)
+    return (pixels[..., 0] << 6 | pixels[..., 1] << 4 | pixels[..., 2] << 2 | pixels[..., 3]).astype(numpy.uint8).tobytes()
+
+
+def unpack_gray4(data, width, height):
+    packed = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, -1, 1)
+    pixels = (packed >> numpy.array([6, 4, 2, 0], dtype=numpy.uint8)) & 3
+    return Image.fromarray((pixels.reshape(height, -1)[:, :width] * 85).astype(numpy.uint8), "L")
+
+
+# Memory-maps a video's frame store, if it has a usable one, so frames can be read without decoding
+class FrameStore:
+    def __init__(self, player, filename):
+        self.player = player
+        self.filename = filename
+        self.data = None
+
+        for storefile in state_paths(player.progressdir, filename, ".frames"):
+            try:
+                with open(f"{storefile}.json") as log:
+                    header = json.load(log)
+                self.count = header.pop("count")
+                self.bits = header["bits"]
+                self.frameBytes = (player.width * self.bits + 7) // 8 * player.height
+                if header != player.store_header(filename) or os.path.getsize(storefile) != self.count * self.frameBytes:
+                    continue
+                import mmap
+                with open(storefile, "rb") as store:
+                    self.data = mmap.mmap(store.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError, KeyError):
+                continue
+            player.logger.debug(f"Playing '{os.path.basename(filename)}' from its frame store")
+            return
+
+    # Return frame number `frame` as a PIL image, or None if it's not in the store
+    def read(self, frame):
+        index, offset = divmod(frame, self.player.args.increment)
+        if not self.data or offset or index >= self.count:
+            return None
+        data = self.data[index * self.frameBytes:(index + 1) * self.frameBytes]
+        size = (self.player.width, self.player.height)
+        if self.bits == 2:
+            return unpack_gray4(data, *size)
+        return Image.frombytes({1: "1", 8: "L", 24: "RGB"}[self.bits], size, data)
+
+    def close(self):
+        if self.data:
+            self.data.close()
+            self.data = None
+
+
+# Rendered frames, ready to display, kept so frames shown again (looping a short video, or random
+# frames from a small library) don't have to be decoded again. The most recently used frames are
+# kept in memory up to `memoryBudget` bytes, and optionally as PNG files in `directory` up to
+# `diskBudget` bytes, which also lasts between runs
+class FrameCache:
+    def __init__(self, memoryBudget, directory=None, diskBudget=0, log=None):
+        self.logger = log or logger
+        self.memoryBudget = memoryBudget
+        self.memory = collections.OrderedDict()
+        self.memorySize = 0
+        self.directory = directory if diskBudget else None
+        self.diskBudget = diskBudget
+        self.disk = None
+        self.diskSize = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    # Rendered frame for `key`, or None
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key][0]
+        if self.directory and key in self.disk_index():
+            path = os.path.join(self.directory, f"{key}.png")
+            try:
+                with Image.open(path) as pil_im:
+                    pil_im.load()
+                os.utime(path)
+            except OSError:
+                self.diskSize -= self.disk.pop(key)
+            else:
+                self.disk.move_to_end(key)
+                self.hits += 1
+                self.diskHits += 1
+                self.put_memory(key, pil_im)
+                return pil_im
+        self.misses += 1
+        return None
 
+    def put(self, key, pil_im):
+        self.put_memory(key, pil_im)
+        if self.directory and key not in self.disk_index():
+            path = os.path.join(self.directory, f"{key}.png")
+            try:
+                pil_im.save(f"{path}.tmp", "PNG")
+                os.replace(f"{path}.tmp", path)
+                size = os.path.getsize(path)
+            except OSError as e:
+                self.logger.warning(f"Couldn't save frame to the frame cache: {e}")
+                return
+            self.disk[key] = size
+            self.diskSize += size
+            while self.diskSize > self.diskBudget and self.disk:
+                oldest, oldestSize = self.disk.popitem(last=False)
+                self.diskSize -= oldestSize
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, f"{oldest}.png"))
+
+    def put_memory(self, key, pil_im):
+        # PIL keeps 1-bit images at a byte per pixel too
+        size = pil_im.width * pil_im.height * len(pil_im.getbands())
+        if size > self.memoryBudget:
+            return
+        if key in self.memory:
+            self.memorySize -= self.memory.pop(key)[1]
+        self.memory[key] = (pil_im, size)
+        self.memorySize += size
+        while self.memorySize > self.memoryBudget:
+            _, (_, oldestSize) = self.memory.popitem(last=False)
+            self.memorySize -= oldestSize
+
+    # Frames in the cache directory with their sizes, least recently used first, listed the first time it's needed
+    def disk_index(self):
+        if self.disk is None:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".png"):
+                    with contextlib.suppress(OSError):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            self.disk = collections.OrderedDict((key, size) for _, key, size in sorted(files))
+            self.diskSize = sum(self.disk.values())
+        return self.disk
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hitRate = f" ({self.hits / lookups * 100:.0f}%)" if lookups else ""
+        diskHits = f", {self.diskHits} from disk" if self.directory else ""
+        self.logger.info(f"Frame cache: {self.hits} hits{hitRate}{diskHits}, {self.misses} misses, {len(self.memory)} frames ({self.memorySize / 2**20:.1f} MB) in memory")
+
+
+# Lookup table for --levels and --gamma, which are the same for every frame
+def tone_curve(levels, gamma):
+    black, white = levels
+    values = numpy.clip((numpy.arange(256) - black) / max(white - black, 1), 0, 1)
+    return values ** (1 / gamma) * 255
+
+
+# Dithering thresholds for every pixel of the display, tiled from the Bayer matrix
+def dither_thresholds(width, height):
+    thresholds = (bayerMatrix.astype(numpy.float32) + 0.5) / 64
+    return numpy.tile(thresholds, (height // 8 + 1, width // 8 + 1))[:height, :width]
+
+
+# Perceptual hash of a frame: whether each cell of a 9x8 thumbnail is brighter than the one to its left
+def frame_hash(pil_im):
+    pixels = numpy.asarray(pil_im.convert("L").resize((9, 8), Image.Resampling.BOX), dtype=numpy.int16)
+    return pixels[:, 1:] > pixels[:, :-1]
+
+
+# Number of differing bits between two frame hashes, from 0 (alike) to 64
+def hash_distance(a, b):
+    return int(numpy.count_nonzero(a != b))
+
+
+# Seconds from an SRT (00:01:02,500) or SSA/ASS (0:01:02.50) timestamp's parts
+def subtitle_time(hours, minutes, seconds, fraction):
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + float(f"0.{fraction}")
+
+
+# (start, end, text) of each cue in an SRT file
+def parse_srt(text):
+    cues = []
+    for match in srtCue.finditer(text):
+        start = subtitle_time(*match.group(1, 2, 3, 4))
+        end = subtitle_time(*match.group(5, 6, 7, 8))
+        cues.append((start, end, subtitleTags.sub("", match.group(9)).strip()))
+    return cues
+
+
+# (start, end, text) of each dialogue line in an SSA/ASS file. Styles and positioning aren't kept
+def parse_ass(text):
+    cues = []
+    fields = None
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() == "Format" and fields is None and "Text" in value:
+            fields = [field.strip() for field in value.split(",")]
+        elif key.strip() == "Dialogue" and fields:
+            values = value.strip().split(",", len(fields) - 1)
+            if len(values) < len(fields):
+                continue
+            event = dict(zip(fields, values))
+            try:
+                start = subtitle_time(*re.split(r"[:.]", event["Start"].strip()))
+                end = subtitle_time(*re.split(r"[:.]", event["End"].strip()))
+            except (KeyError, TypeError, ValueError):
+                continue
+            cueText = subtitleTags.sub("", event["Text"]).replace("\\N", "\n").replace("\\n", "\n").replace("\\h", " ")
+            cues.append((start, end, cueText.strip()))
+    return cues
+
+
+# The cues of a subtitle file, indexed by time so the ones showing at any moment can be found quickly
+class Subtitles:
+    def __init__(self, filename):
+        with open(filename, encoding="utf-8-sig", errors="replace") as file:
+            text = file.read().replace("\r\n", "\n").replace("\r", "\n")
+        _, ext = os.path.splitext(filename)
+        cues = parse_ass(text) if ext.lower() in (".ssa", ".ass") else parse_srt(text)
+        self.cues = sorted(cue for cue in cues if cue[2])
+        self.starts = [start for start, _, _ in self.cues]
+        # Latest end time of the cues up to each one, so a search can stop once no earlier cue is still showing
+        self.maxEnds = list(itertools.accumulate((end for _, end, _ in self.cues), max))
+        logger.debug(f"Loaded {len(self.cues)} subtitles from '{filename}'")
+
+    # Text of the cues showing `time` seconds into the video, one per line
+    def text_at(self, time):
+        index = bisect.bisect_right(self.starts, time)
+        lines = []
+        while index and self.maxEnds[index - 1] > time:
+            index -= 1
+            _, end, text = self.cues[index]
+            if end > time:
+                lines.insert(0, text)
+        return "\n".join(lines)
+
+
+# Draw text onto a copy of a frame, from (position, outline mask, fill mask) for each piece of it.
+# Outlines are drawn in black first, so they don't cover the white fill of neighbouring characters
+def draw_masks(pil_im, masks):
+    pil_im = pil_im.copy()
+    black = ImageColor.getcolor("black", pil_im.mode)
+    white = ImageColor.getcolor("white", pil_im.mode)
+    for position, outline, _ in masks:
+        pil_im.paste(black, position, outline)
+    for position, _, fill in masks:
+        pil_im.paste(white, position, fill)
+    return pil_im
+
+
+# Font for text overlays: DejaVu Sans, which Raspberry Pi OS comes with, or Pillow's own font
+def load_font(size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        pass
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow before 10.1 only has a small bitmap font
+        return ImageFont.load_default()
+
+
+# Times each stage of a refresh, and reports rolling statistics to the log and optionally a metrics file
+class StageTimer:
+    def __init__(self, window, interval, metricsFile=None, log=None):
+        self.log = log or logger
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.current = collections.defaultdict(float)
+        self.interval = interval
+        self.metricsFile = metricsFile
+        self.count = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] += time.perf_counter() - start
+
+    # Record the stages timed since the last refresh, along with any extra details about it
+    def finish(self, **details):
+        for name, seconds in self.current.items():
+            self.samples[name].append(seconds)
+        if self.metricsFile:
+            with open(self.metricsFile, "a") as metrics:
+                metrics.write(json.dumps({"time": time.time(), **details, "stages": {name: round(seconds, 4) for name, seconds in self.current.items()}}) + "\n")
+        self.current.clear()
+
+        self.count += 1
+        if self.interval and self.count % self.interval == 0:
+            self.report()
+
+    def report(self):
+        stats = []
+        for name, samples in self.samples.items():
+            p50, p95 = numpy.percentile(samples, [50, 95])
+            stats.append(f"{name} {p50:.3f}/{p95:.3f}/{max(samples):.3f}s")
+        self.log.info(f"Refresh timings over the last {max(map(len, self.samples.values()), default=0)} refreshes (p50/p95/max): {', '.join(stats)}")
+
+
+# Keeps a copy of what's on the display, so frames that only change a small area can be
+# sent with a partial refresh instead of refreshing the whole panel. Partial refreshes go straight
+# to the driver underneath omni-epd, so they're only used for black and white displays that aren't
+# set up to change images first
+class PartialRefresh:
+    def __init__(self, epd, threshold, fullEvery, name):
+        self.epd = epd
+        self.threshold = threshold
+        self.fullEvery = fullEvery
+        self.last = None
+        self.next = None
+        self.partials = 0
+        self.supported = True
+        transforms = display_transforms(name)
+        if getattr(epd, "mode", "bw") != "bw":
+            logger.warning(f"Partial refreshes are only done for black and white displays, using full refreshes on the {name} display")
+            self.supported = False
+        elif transforms:
+            logger.warning(f"Partial refreshes would skip the {name} display's omni-epd settings ({', '.join(transforms)}), using full refreshes")
+            self.supported = False
+        # Frames for other displays are compared as they are
+        self.dither = self.supported
+
+    # Dither a frame the way the driver would, and find the box of the display it changes (None for
+    # the whole display). Returns False if it doesn't change anything, so the display needn't be woken
+    def compare(self, pil_im):
+        dithered = pil_im.convert("1") if self.dither else pil_im
+        pixels = numpy.asarray(dithered)
+        box = None
+        if self.last is not None:
+            # Bounding box of the changed pixels, widened to whole bytes of the display's buffer
+            changed = pixels != self.last
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            rows = numpy.flatnonzero(changed.any(axis=1))
+            if not rows.size:
+                self.next = None
+                return False
+            cols = numpy.flatnonzero(changed.any(axis=0))
+            box = (int(cols[0]) // 8 * 8, int(rows[0]), min(-(-(int(cols[-1]) + 1) // 8) * 8, self.epd.width), int(rows[-1]) + 1)
+        self.next = (pil_im, dithered, pixels, box)
+        return True
+
+    def display(self, pil_im):
+        if not (self.next and self.next[0] is pil_im) and not self.compare(pil_im):
+            return
+        _, dithered, pixels, box = self.next
+        self.next = None
+
+        if box and self.supported and self.partials < self.fullEvery:
+            area = (box[2] - box[0]) * (box[3] - box[1]) / (self.epd.width * self.epd.height)
+            # Crop the whole dithered frame, so the box's edges match what's around it
+            if area <= self.threshold and self.display_partial(dithered.crop(box), box):
+                logger.debug(f"Partial refresh of {box} ({area * 100:.1f}% of the display)")
+                self.partials += 1
+                self.last = pixels
+                return
+
+        self.epd.display(pil_im)
+        self.partials = 0
+        self.last = pixels
+
+    # Refresh only `box` of the display with `crop`, if the driver supports it. Returns False if it doesn't
+    def display_partial(self, crop, box):
+        # omni-epd doesn't expose partial updates itself, but some Waveshare drivers underneath it do
+        device = getattr(self.epd, "_device", None)
+        if not (callable(getattr(device, "init_part", None)) and callable(getattr(device, "display_Partial", None))):
+            logger.warning("This display doesn't support partial refreshes, using full refreshes")
+            self.supported = False
+            return False
+        try:
+            device.init_part()
+            device.display_Partial(bytearray(crop.tobytes()), *box)
+        except Exception as e:
+            logger.warning(f"Partial refresh failed ({e}), using full refreshes")
+            self.supported = False
+            return False
+        return True
+
+
+# Saves which video is playing and how far each video has got, as JSON lines appended to a journal.
+# Updates are kept in memory and appended together every `interval` seconds and on close, and the
+# journal is rewritten from scratch (to a temporary file, then renamed over it) once it gets long.
+# A line cut short by a power cut is ignored, so reading it back gives the last saved position
+# instead of starting over. Reads the separate progress and nowPlaying files older versions wrote
+# for anything the journal doesn't have yet
+class ProgressJournal:
+    def __init__(self, progressdir, nowPlayingFile, interval, log=None):
+        self.progressdir = progressdir
+        self.nowPlayingFile = nowPlayingFile
+        self.interval = interval
+        self.logger = log or logger
+        self.filename = os.path.join(progressdir, "journal")
+        self.frames = {}
+        self.nowPlaying = None
+        self.pending = []
+        self.lines = 0
+        self.lastFlush = time.monotonic()
+
+        damaged = False
+        if os.path.isfile(self.filename):
+            with open(self.filename, "rb") as file:
+                data = file.read()
+            damaged = bool(data) and not data.endswith(b"\n")
+            for line in data.splitlines():
+                try:
+                    self.apply(json.loads(line))
+                    self.lines += 1
+                except (ValueError, TypeError, KeyError):
+                    damaged = True
+        if damaged:
+            # Start afresh rather than appending to a cut-off line
+            self.logger.warning(f"Ignoring damaged lines in '{self.filename}'")
+            self.compact()
+
+    def apply(self, entry):
+        if "nowPlaying" in entry:
+            self.nowPlaying = entry["nowPlaying"]
+        else:
+            self.frames[entry["video"]] = int(entry["frame"])
+
+    # Last saved frame of the video saved as `key`, or None. Older versions saved progress under just
+    # the video's file name, `videoFilename`, which is used if there's nothing under `key`
+    def frame(self, key, videoFilename=None):
+        videoFilename = videoFilename or key
+        for name in (key, videoFilename):
+            if name in self.frames:
+                return self.frames[name]
+        try:
+            with open(os.path.join(self.progressdir, f"{videoFilename}.progress")) as file:
+                return int(file.readline())
+        except (OSError, ValueError):
+            return None
+
+    # Path of the video that was playing, or None
+    def now_playing(self):
+        if self.nowPlaying is None and os.path.isfile(self.nowPlayingFile):
+            with open(self.nowPlayingFile) as file:
+                return file.readline().strip() or None
+        return self.nowPlaying
+
+    def save_frame(self, key, frame):
+        self.frames[key] = frame
+        self.save({"video": key, "frame": frame})
+
+    def save_now_playing(self, video):
+        if video == self.nowPlaying:
+            return
+        self.nowPlaying = video
+        self.save({"nowPlaying": video})
+
+    def save(self, entry):
+        self.pending.append(entry)
+        if time.monotonic() - self.lastFlush >= self.interval:
+            self.flush()
+
+    # Append the updates since the last flush to the journal
+    def flush(self):
+        self.lastFlush = time.monotonic()
+        if not self.pending:
+            return
+        # Only the latest of several updates to the same thing needs keeping
+        latest = {entry.get("video"): entry for entry in self.pending}
+        self.pending = []
+        if self.lines + len(latest) > journalSlack * (len(self.frames) + 1):
+            self.compact()
+            return
+        with open(self.filename, "a") as file:
+            file.writelines(json.dumps(entry) + "\n" for entry in latest.values())
+            file.flush()
+            os.fsync(file.fileno())
+        self.lines += len(latest)
+
+    # Rewrite the journal with just the current state
+    def compact(self):
+        self.pending = []
+        entries = [{"video": video, "frame": frame} for video, frame in self.frames.items()]
+        if self.nowPlaying is not None:
+            entries.append({"nowPlaying": self.nowPlaying})
+        with open(f"{self.filename}.tmp", "w") as file:
+            file.writelines(json.dumps(entry) + "\n" for entry in entries)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{self.filename}.tmp", self.filename)
+        # Make sure the rename itself survives a power cut
+        with contextlib.suppress(OSError):
+            dirfd = os.open(self.progressdir, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        self.lines = len(entries)
+
+    def close(self):
+        self.flush()
+
+
+# Prefixes log messages with the name of the display they're about, when driving several displays
+class DisplayLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        if self.extra["name"]:
+            msg = f"[{self.extra['name']}] {msg}"
+        return msg, kwargs
+
+
+# Plays videos on one display. Holds all of the playback's state (settings, display, position,
+# decoder and caches), so it can be stepped one refresh at a time and several can run side by side.
+# Players driven together are given a `name`, their own state directory and a shared render `pool`
+class Player:
+    def __init__(self, args, epd, progressdir="progress", nowPlayingFile="nowPlaying", name=None, pool=None):
+        self.args = args
+        self.epd = epd
+        self.width = epd.width
+        self.height = epd.height
+        self.progressdir = progressdir
+        self.nowPlayingFile = nowPlayingFile
+        self.name = name
+        self.logger = DisplayLogger(logger, {"name": name})
+
+        # Set path of Videos directory. Videos directory can be specified by CLI --directory
+        if args.directory:
+            self.viddir = args.directory
+        else:
+            self.viddir = "Videos"
+
+        # Create progress and Videos directories if missing
+        if not os.path.isdir(progressdir):
+            os.makedirs(progressdir)
+        if not os.path.isdir(self.viddir):
+            os.mkdir(self.viddir)
+        self.library = VideoLibrary(self.viddir, self.logger)
+        self.journal = ProgressJournal(progressdir, nowPlayingFile, args.save_interval, self.logger)
+
+        self.toneCurve = tone_curve(args.levels, args.gamma)
+        self.ditherThresholds = dither_thresholds(self.width, self.height)
+        self.timer = StageTimer(args.stats_window, args.stats_interval, args.metrics_file, self.logger)
+
+        self.videoInfos = {}
+        self.infoCacheFile = os.path.join(progressdir, "videoinfo.json")
+        self.infoCache = self.load_info_cache()
+
+        self.decoder = None
+        self.frameStore = None
+        # Builds keyframe indexes in the background, and the videos it's working on with their futures
+        self.indexer = ThreadPoolExecutor(max_workers=1)
+        self.indexing = {}
+        self.frameCache = None
+        # Frames are only shown again when looping or picking random frames, so the in-memory cache is off otherwise
+        frameCacheSize = args.frame_cache if args.frame_cache is not None else 32 if args.loop or args.random_frames else 0
+        if frameCacheSize or args.frame_cache_disk:
+            self.frameCache = FrameCache(frameCacheSize * 2**20, os.path.join(progressdir, "framecache"), args.frame_cache_disk * 2**20, self.logger)
+
+        # Parsed subtitle files, and rendered subtitle cues with the most recently used last
+        self.subtitleFiles = {}
+        self.textCache = collections.OrderedDict()
+        self.font = None
+        # Rendered timecode characters
+        self.glyphs = None
+
+        # FFmpeg decoder picked for each video (None for software decoding)
+        self.videoDecoders = {}
+
+        # Worker for rendering the next frame during the delay between refreshes
+        if pool:
+            self.prefetcher = pool
+        else:
+            self.prefetcher = ThreadPoolExecutor(max_workers=1) if args.prefetch else None
+        self.sharedPool = pool is not None
+        self.prefetch = None
+
+        self.partialRefresh = PartialRefresh(epd, args.partial_refresh, args.full_refresh_every, args.epd) if args.partial_refresh else None
+
+        # Hash of the frame on the display, for --skip-similar
+        self.lastHash = None
+
+        self.currentVideo = None
+        self.currentFrame = 0
+        self.keyframe = None
+        # When the current video was last checked for a new optimized copy
+        self.sourceChecked = 0
+        # So that the first step prints "Playing x"
+        self.lastVideo = None
+
+    # Number of bytes in one raw frame at the display size
+    def frame_size(self, pixelFormat=None):
+        _, _, bits = pixelFormats[pixelFormat or self.args.pixel_format]
+        return (self.width * bits + 7) // 8 * self.height
+
+    # Wrap a raw frame in a PIL image without decoding it
+    def frame_image(self, buffer, pixelFormat=None):
+        _, mode, _ = pixelFormats[pixelFormat or self.args.pixel_format]
+        return Image.frombuffer(mode, (self.width, self.height), buffer, "raw", mode, 0, 1)
+
+    # Crop, scale and letterbox/pillarbox a video stream to fit the display. Text overlays are added
+    # afterwards by overlay_frame, so this is the same with or without them. The crop and size are worked out from the probed video size, so there's only one scaling pass
+    def frame_filters(self, stream, video, info):
+        cropWidth, cropHeight, scaleWidth, scaleHeight = self.frame_geometry(info, self.lowres_factor(video, info))
+        if self.args.fullscreen:
+            stream = stream.filter("crop", f"min(iw,{cropWidth})", f"min(ih,{cropHeight})")
+        stream = stream.filter("scale", scaleWidth, scaleHeight)
+        if (scaleWidth, scaleHeight) != (self.width, self.height):
+            stream = stream.filter("pad", self.width, self.height, -1, -1)
+        return stream
+
+    # FFmpeg output that streams raw frames in the selected pixel format to stdout
+    def frame_output(self, stream, pixelFormat=None, **kwargs):
+        ffmpegFormat, _, _ = pixelFormats[pixelFormat or self.args.pixel_format]
+        if self.args.frame_exact:
+            # Output every frame once, instead of repeating or dropping frames to keep a constant frame rate
+            kwargs.setdefault("vsync", "passthrough")
+        return (
+            stream
+            .output("pipe:", format="rawvideo", pix_fmt=ffmpegFormat, copyts=None, **kwargs)
+            .global_args("-nostdin", "-loglevel", "error")
+        )
+
+    # Extract a single frame at `time`, returning None if there's no frame there.
+    # Without `accurate`, the first frame decoded after seeking is used (e.g. when seeking to a keyframe)
+    def generate_frame(self, in_filename, info, time, accurate=True):
+        seekArgs = {} if accurate else {"noaccurate_seek": None}
+        stream = self.input_stream(in_filename, info, ss=time, **seekArgs)
+        process = self.frame_output(self.frame_filters(stream, in_filename, info), vframes=1).run_async(pipe_stdout=True, pipe_stderr=True)
+        buffer = bytearray(self.frame_size())
+        complete = read_frame(process.stdout, buffer)
+        _, err = process.communicate()
+        if process.returncode:
+            if self.decoder_failed(in_filename):
+                return self.generate_frame(in_filename, info, time, accurate)
+            raise ffmpeg.Error("ffmpeg", None, err)
+        return self.frame_image(buffer) if complete else None
+
+    # Open a video for decoding, with a hardware decoder if one has been picked for it. Otherwise, with
+    # --fast-decode, let the software decoder skip detail that scaling down to the display would lose anyway
+    def input_stream(self, video, info, **kwargs):
+        decoder = self.video_decoder(video, info)
+        if decoder:
+            kwargs["vcodec"] = decoder
+        elif self.args.fast_decode:
+            lowres = self.lowres_factor(video, info)
+            if lowres:
+                kwargs["lowres"] = lowres
+            if info["codec"] in deblockingCodecs and max(self.frame_scale(info)) <= 0.5:
+                # Blocking artifacts are smaller than a pixel once frames are halved in size
+                kwargs["skip_loop_filter"] = "all"
+        return ffmpeg.input(info["source"], **kwargs)
+
+    # Which part of a video's decoded frames to show, and the size to scale it to: the display size
+    # with --fullscreen, otherwise as large as fits with the video's shape. Frames are `lowres` times
+    # halved in size by the decoder
+    def frame_geometry(self, info, lowres=0):
+        # lowres rounds odd sizes up
+        frameWidth = -(-info["width"] >> lowres)
+        frameHeight = -(-info["height"] >> lowres)
+        displayRatio = self.width / self.height
+        cropWidth, cropHeight = frameWidth, frameHeight
+        if self.args.fullscreen:
+            # Cut the sides or the top and bottom off, allowing for non-square pixels
+            if info["aspect_ratio"] > displayRatio:
+                cropWidth = max(round(frameHeight * displayRatio / info["sar"]), 1)
+            elif info["aspect_ratio"] < displayRatio:
+                cropHeight = max(round(frameWidth * info["sar"] / displayRatio), 1)
+            return cropWidth, cropHeight, self.width, self.height
+        if info["aspect_ratio"] > displayRatio:
+            return cropWidth, cropHeight, self.width, max(round(self.width / info["aspect_ratio"]), 1)
+        return cropWidth, cropHeight, max(round(self.height * info["aspect_ratio"]), 1), self.height
+
+    # How much a video's frames are scaled horizontally and vertically to fit the display
+    def frame_scale(self, info):
+        cropWidth, cropHeight, scaleWidth, scaleHeight = self.frame_geometry(info)
+        return scaleWidth / cropWidth, scaleHeight / cropHeight
+
+    # How many times the decoder can halve a video's resolution with --fast-decode, while still
+    # giving at least as much detail as the display shows. Only some software decoders can do this
+    def lowres_factor(self, video, info):
+        if not self.args.fast_decode or info["codec"] not in lowresCodecs or self.video_decoder(video, info):
+            return 0
+        scale = max(self.frame_scale(info))
+        lowres = 0
+        while lowres < 3 and scale * 2 ** (lowres + 1) <= 1:
+            lowres += 1
+        return lowres
+
+    # Pick the FFmpeg decoder for a video, depending on --decoder: a hardware decoder for its codec
+    # that's available and hasn't failed, or None for FFmpeg's own software decoder
+    def video_decoder(self, video, info):
+        if video in self.videoDecoders:
+            return self.videoDecoders[video]
+
+        choice = self.args.decoder
+        decoder = None
+        if choice == "auto":
+            for candidate in hardwareDecoders.get(info["codec"], []):
+                if candidate in ffmpeg_decoders() and hardware_present(candidate):
+                    decoder = candidate
+                    break
+        elif choice != "software":
+            if choice not in ffmpeg_decoders():
+                self.logger.warning(f"FFmpeg doesn't have a decoder called '{choice}', using software decoding")
+            elif not decoder_for(choice, info["codec"]):
+                self.logger.info(f"The {choice} decoder isn't for {info['codec']} videos")
+            else:
+                decoder = choice
+
+        if decoder:
+            self.logger.info(f"Decoding '{os.path.basename(video)}' ({info['codec']}) with the {decoder} decoder")
+        else:
+            self.logger.info(f"Decoding '{os.path.basename(video)}' ({info['codec']}) in software")
+        self.videoDecoders[video] = decoder
+        return decoder
+
+    # Called when FFmpeg fails decoding a video. If it was using a hardware (or forced) decoder, switch the
+    # video to software decoding and return True, so the caller can try again. Other videos still try
+    # the decoder, as it may only have failed on this one (e.g. an unsupported profile)
+    def decoder_failed(self, video):
+        decoder = self.videoDecoders.get(video)
+        if not decoder:
+            return False
+        self.logger.warning(f"The {decoder} decoder failed on '{os.path.basename(video)}', falling back to software decoding")
+        self.videoDecoders[video] = None
+        return True
+
+    # Get info about a video, from memory, the probe cache in the progress directory, or FFprobe.
+    # Cached probe results are used as long as the video's modification time and size haven't changed
+    def video_info(self, file):
+        if file in self.videoInfos:
+            return self.videoInfos[file]
+
+        # Decode the video's optimized copy instead, if it has an up to date one
+        source = self.optimized_copy(file) or file
+        if source != file:
+            self.logger.debug(f"Playing '{os.path.basename(file)}' from its optimized copy")
+
+        entry = self.cached_info(source)
+        changed = not entry
+        if changed:
+            stat = os.stat(source)
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size, "version": probeVersion, "info": probe_video(source)}
+            self.infoCache[os.path.abspath(source)] = entry
+        info = dict(entry["info"])
+        info["source"] = source
+
+        # Adding or removing a subtitle file changes the directory's modification time
+        if self.args.subtitles:
+            dirMtime = os.stat(os.path.dirname(os.path.abspath(file))).st_mtime
+            if entry.get("subtitle_dir_mtime") != dirMtime:
+                entry["subtitle_file"] = find_subtitles(file)
+                entry["subtitle_dir_mtime"] = dirMtime
+                changed = True
+            info["subtitle_file"] = entry["subtitle_file"]
+        else:
+            info["subtitle_file"] = None
+
+        if changed:
+            self.save_info_cache()
+
+        # Unless --fast-random needs it straight away, a video's keyframe index is built once it's playing
+        info["keyframes"] = keyframe_index(source, info["start_time"], self.progressdir, build=self.args.fast_random)
+
+        # With --frame-exact, frames are found by their timestamps, and the frame count is exact
+        info["frame_times"] = None
+        if self.args.frame_exact:
+            times = frame_times(source, info["start_time"], self.progressdir)
+            if len(times):
+                info["frame_times"] = times
+                info["frame_count"] = len(times)
+            else:
+                self.logger.warning(f"Couldn't find the timestamps of the frames of '{os.path.basename(file)}', so its frames aren't exact")
+        self.videoInfos[file] = info
+        return info
+
+    # Number of the last frame of a video. Frame counts that aren't exact can be a little short, so the
+    # frame after the last one is tried too
+    def last_frame(self, info):
+        return info["frame_count"] - 1 if info["frame_times"] is not None else info["frame_count"]
+
+    # When frame number `frame` is shown, in seconds from the start of the video
+    def frame_seconds(self, info, frame):
+        times = info["frame_times"]
+        if times is None:
+            return frame * info["frame_time"] / 1000
+        return float(times[min(frame, len(times) - 1)])
+
+    # Number of the first frame shown at or after `seconds`
+    def frame_at(self, info, seconds):
+        times = info["frame_times"]
+        if times is None:
+            return round(seconds * 1000 / info["frame_time"])
+        # Allow for times having been rounded differently
+        return int(numpy.searchsorted(times, seconds - 1e-6))
+
+    # Where to seek to for frame number `frame`, for FFmpeg's -ss. With --frame-exact, that's halfway
+    # between the frame's timestamp and the one before it, so FFmpeg can't round to the wrong frame
+    def frame_seek(self, info, frame):
+        times = info["frame_times"]
+        if times is None:
+            return f"{int(frame * info['frame_time'])}ms"
+        if frame >= len(times):
+            seconds = times[-1] + 1
+        elif frame > 0:
+            seconds = (times[frame - 1] + times[frame]) / 2
+        else:
+            seconds = 0
+        return f"{seconds * 1000:.3f}ms"
+
+    # Saved probe results for a video, unless it's changed since
+    def cached_info(self, file):
+        path = os.path.abspath(file)
+        stat = os.stat(path)
+        entry = self.infoCache.get(path)
+        if not entry or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size or entry.get("version") != probeVersion:
+            return None
+        return entry
+
+    # Probe every video (or just --file) and build their keyframe indexes, in `pool`'s worker
+    # processes, saving the results to the probe cache. Returns each video's probe results
+    def index(self, pool):
+        videos = [self.args.file] if self.args.file else self.library.paths()
+        entries = {}
+        jobs = {}
+        for video in videos:
+            source = self.optimized_copy(video) or video
+            entry = self.cached_info(source)
+            if entry and "keyframe_count" in entry and not (self.args.frame_exact and frame_times(source, entry["info"]["start_time"], self.progressdir, build=False) is None):
+                entries[video] = entry
+            else:
+                jobs[pool.submit(index_video, source, video, self.progressdir, self.args.frame_exact)] = (video, source)
+
+        if jobs:
+            self.logger.info(f"Indexing {len(jobs)} of {len(videos)} videos")
+        try:
+            for job in concurrent.futures.as_completed(jobs):
+                video, source = jobs[job]
+                try:
+                    entries[video] = self.infoCache[os.path.abspath(source)] = job.result()
+                except Exception as e:
+                    self.logger.warning(f"Couldn't index '{os.path.basename(video)}': {e}")
+        finally:
+            # If interrupted, drop the videos that haven't started and keep what's been indexed so far
+            for job in jobs:
+                job.cancel()
+            if jobs:
+                self.save_info_cache()
+        return {video: entries[video] for video in videos if video in entries}
+
+    # Load saved probe results, leaving out videos that no longer exist
+    def load_info_cache(self):
+        try:
+            with open(self.infoCacheFile) as cache:
+                entries = json.load(cache)
+        except (OSError, ValueError):
+            return {}
+        return {path: entry for path, entry in entries.items() if os.path.isfile(path)}
+
+    def save_info_cache(self):
+        # Write to a temporary file and swap it in, so an interrupted write can't corrupt the cache
+        with open(f"{self.infoCacheFile}.tmp", "w") as cache:
+            json.dump(self.infoCache, cache)
+        os.replace(f"{self.infoCacheFile}.tmp", self.infoCacheFile)
+
+    # Frames rendered ahead of time with --prerender are packed into a file per video, at the
+    # display's own depth: 1 bit per pixel for mono frames or black and white displays, 2 for 4 gray
+    # levels, and full 8-bit gray or 24-bit color for other displays
+    def store_bits(self):
+        levels = displayLevels.get(getattr(self.epd, "mode", "bw"))
+        if self.args.pixel_format == "mono" or levels == 2:
+            return 1
+        if levels == 4:
+            return 2
+        return 8 if self.gray_frames() else 24
+
+    def store_path(self, file):
+        return state_paths(self.progressdir, file, ".frames")[0]
+
+    # Everything a frame store depends on, which has to match for it to be played back
+    def store_header(self, file):
+        stat = os.stat(file)
+        return {
+            "path": os.path.abspath(file),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "width": self.width,
+            "height": self.height,
+            "bits": self.store_bits(),
+            "increment": self.args.increment,
+            "fullscreen": self.args.fullscreen,
+            "subtitles": self.args.subtitles,
+            "timecode": self.args.timecode,
+            "contrast": self.args.contrast,
+            "gamma": self.args.gamma,
+            "levels": self.args.levels,
+            "dither": self.args.dither,
+            "fast_decode": self.args.fast_decode}
+
+    # Decode a whole video in one pass and save every INCREMENTth frame, ready to display, in its frame store
+    def prerender(self, file):
+        storefile = self.store_path(file)
+        header = self.store_header(file)
+        existing = FrameStore(self, file)
+        if existing.data:
+            existing.close()
+            self.logger.info(f"Frames for '{os.path.basename(file)}' are already rendered")
+            return
+
+        info = self.video_info(file)
+        increment = self.args.increment
+        pixelFormat = "mono" if self.args.pixel_format == "mono" else "rgb" if header["bits"] == 24 else "gray"
+        total = -(-info["frame_count"] // increment)
+        self.logger.info(f"Rendering {total} frames of '{os.path.basename(file)}' (about {total * (self.width * header['bits'] + 7) // 8 * self.height / 1024 ** 2:.0f}MB)")
+
+        stream = self.input_stream(file, info).filter("select", f"not(mod(n,{increment}))")
+        process = self.frame_output(self.frame_filters(stream, file, info), pixelFormat, vsync="passthrough").run_async(pipe_stdout=True)
+        buffer = bytearray(self.frame_size(pixelFormat))
+        count = 0
+        with open(f"{storefile}.tmp", "wb") as store:
+            while read_frame(process.stdout, buffer):
+                pil_im = self.overlay_frame(self.frame_image(buffer, pixelFormat), file, count * increment)
+                pil_im = self.process_frame(pil_im)
+                if header["bits"] == 1 and pil_im.mode != "1":
+                    # Dither it the way the display driver would have
+                    pil_im = pil_im.convert("1")
+                store.write(pack_gray4(pil_im) if header["bits"] == 2 else pil_im.tobytes())
+                count += 1
+                if count % max(total // 10, 100) == 0:
+                    self.logger.info(f"...{count} of {total} frames rendered")
+        if process.wait():
+            os.remove(f"{storefile}.tmp")
+            if self.decoder_failed(file):
+                return self.prerender(file)
+            self.logger.error(f"FFmpeg failed while rendering '{os.path.basename(file)}'")
+            return
+
+        os.replace(f"{storefile}.tmp", storefile)
+        with open(f"{storefile}.json", "w") as log:
+            json.dump({**header, "count": count}, log)
+        self.logger.info(f"Rendered {count} frames of '{os.path.basename(file)}'")
+
+    # Whether frames for this display can be gray: for black and white or grayscale displays, or
+    # frames extracted in gray anyway
+    def gray_frames(self):
+        return self.args.pixel_format != "rgb" or getattr(self.epd, "mode", "bw") in displayLevels
+
+    # Where --optimize puts its copy of a video for this display. Videos with the same name in
+    # different directories are told apart by a hash of their path
+    def optimized_path(self, file):
+        stem, _ = os.path.splitext(os.path.basename(file))
+        pathHash = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()[:8]
+        return os.path.join(optimizedDir, f"{stem}-{pathHash}-{self.width}x{self.height}{'-gray' if self.gray_frames() else ''}.mp4")
+
+    # Path of a video's optimized copy for this display, if it's been made since the video last changed
+    def optimized_copy(self, file):
+        target = self.optimized_path(file)
+        entry = load_manifest().get(os.path.basename(target))
+        if not entry or not os.path.isfile(target):
+            return None
+        stat = os.stat(file)
+        if entry["original"] != os.path.abspath(file) or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            return None
+        return target
+
+    # Make a copy of a video that's quick to decode and seek in on this display: shrunk to just
+    # cover the display, in gray for black and white or grayscale displays, with a keyframe every
+    # second and no audio. Frames and their timestamps stay the same, so progress carries over.
+    # Returns whether the video has an up to date copy
+    def optimize(self, file):
+        name = os.path.basename(file)
+        if self.optimized_copy(file):
+            self.logger.debug(f"'{name}' is already optimized")
+            return True
+        target = self.optimized_path(file)
+        try:
+            stat = os.stat(file)
+            info = probe_video(file)
+        except ffmpeg.Error as e:
+            self.logger.error(f"Couldn't read '{name}' to optimize it: {ffmpeg_message(e)}")
+            return False
+        except (OSError, LookupError, ValueError) as e:
+            self.logger.error(f"Couldn't read '{name}' to optimize it: {e}")
+            return False
+
+        # Shrink to cover the display with square pixels, but never enlarge. H.264 needs even sizes
+        displayRatio = self.width / self.height
+        if info["aspect_ratio"] > displayRatio:
+            height = min(self.height, info["height"])
+            width = height * info["aspect_ratio"]
+        else:
+            width = min(self.width, round(info["width"] * info["sar"]))
+            height = width / info["aspect_ratio"]
+        width, height = max(round(width / 2) * 2, 2), max(round(height / 2) * 2, 2)
+
+        self.logger.info(f"Optimizing '{name}' ({info['width']}x{info['height']} {info['codec']}) to {width}x{height}{' gray' if self.gray_frames() else ''}")
+        timeStart = time.perf_counter()
+        os.makedirs(optimizedDir, exist_ok=True)
+        stream = ffmpeg.input(file).video.filter("scale", width, height).filter("setsar", 1)
+        if self.gray_frames():
+            # Kept as YUV 4:2:0 with blank color, which hardware decoders can still decode
+            stream = stream.filter("format", "gray")
+        process = (
+            stream
+            .output(f"{target}.part", f="mp4", vcodec="libx264", pix_fmt="yuv420p", preset="veryfast", tune="fastdecode", crf=23,
+                    g=max(round(info["fps"]), 1), vsync="passthrough", movflags="+faststart", an=None, sn=None, dn=None)
+            .global_args("-nostdin", "-loglevel", "error")
+            .overwrite_output()
+            .run_async()
+        )
+        try:
+            failed = process.wait() != 0
+        finally:
+            # Stop FFmpeg if we're interrupted, the copy is made again from the start next time
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+                with contextlib.suppress(OSError):
+                    os.remove(f"{target}.part")
+        if failed:
+            with contextlib.suppress(OSError):
+                os.remove(f"{target}.part")
+            self.logger.error(f"FFmpeg failed while optimizing '{name}'")
+            return False
+
+        os.replace(f"{target}.part", target)
+        update_manifest(os.path.basename(target), {"original": os.path.abspath(file), "mtime": stat.st_mtime, "size": stat.st_size})
+        self.logger.info(f"Optimized '{name}' in {time.perf_counter() - timeStart:.0f}s ({stat.st_size / 2**20:.0f}MB to {os.path.getsize(target) / 2**20:.0f}MB)")
+        return True
+
+    # Pick a random frame of a video. With --fast-random only keyframes are picked, and the keyframe's time is returned too
+    def random_frame(self, info):
+        if self.args.fast_random and info["keyframes"]:
+            keyframe = random.choice(info["keyframes"])
+            return self.frame_at(info, keyframe), keyframe
+        return random.randint(0, self.last_frame(info)), None
+
+    # Extract a frame and apply any image adjustments, returning None if the frame couldn't be extracted
+    def render_frame(self, video, frame, keyframe=None):
+        with self.timer.stage("decode"):
+            # Frames from a frame store are ready to display as they are
+            pil_im = self.stored_frame(video, frame)
+            if pil_im:
+                return pil_im
+            if self.frameCache:
+                cacheKey = self.frame_cache_key(video, frame, keyframe)
+                pil_im = self.frameCache.get(cacheKey)
+                if pil_im:
+                    return pil_im
+            pil_im = self.extract_frame(video, frame, keyframe)
+
+        if not pil_im:
+            return None
+        with self.timer.stage("overlay"):
+            pil_im = self.overlay_frame(pil_im, video, frame)
+        with self.timer.stage("process"):
+            pil_im = self.process_frame(pil_im)
+        if self.frameCache:
+            self.frameCache.put(cacheKey, pil_im)
+        return pil_im
+
+    # Everything a rendered frame depends on, hashed: the video and its modification time, which
+    # frame, the display and all the settings that change how frames look
+    def frame_cache_key(self, video, frame, keyframe=None):
+        key = self.store_header(video)
+        del key["increment"], key["bits"]
+        key.update({
+            "frame": frame,
+            "keyframe": keyframe,
+            "pixel_format": self.args.pixel_format,
+            "frame_exact": self.args.frame_exact,
+            "mode": getattr(self.epd, "mode", "bw")})
+        subtitleFile = self.video_info(video)["subtitle_file"]
+        if self.args.subtitles and subtitleFile:
+            key["subtitle_mtime"] = os.stat(subtitleFile).st_mtime
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    # Draw the timecode, or any subtitles showing at `frame`, onto the frame
+    def overlay_frame(self, pil_im, video, frame):
+        if not (self.args.timecode or self.args.subtitles):
+            return pil_im
+        info = self.video_info(video)
+        seconds = self.frame_seconds(info, frame)
+        if self.args.timecode:
+            return self.draw_timecode(pil_im, seconds)
+        if not info["subtitle_file"]:
+            return pil_im
+        text = self.subtitles(info["subtitle_file"]).text_at(seconds)
+        if text:
+            pil_im = self.draw_text(pil_im, text)
+        return pil_im
+
+    # Draw the time as HH:MM:SS.mmm centered near the bottom of the frame, one pre-rendered character at a time
+    def draw_timecode(self, pil_im, seconds):
+        if not self.glyphs:
+            self.glyphs = self.render_glyphs()
+        milliseconds = round(seconds * 1000)
+        text = f"{milliseconds // 3600000:02d}:{milliseconds // 60000 % 60:02d}:{milliseconds // 1000 % 60:02d}.{milliseconds % 1000:03d}"
+
+        height = self.glyphs[":"][1].height - 2 * timecodeOutline
+        left = (self.width - sum(self.glyphs[char][0] for char in text)) / 2
+        top = self.height - height * 2 - timecodeOutline
+        masks = []
+        for char in text:
+            advance, outline, fill = self.glyphs[char]
+            masks.append(((round(left) - timecodeOutline, top), outline, fill))
+            left += advance
+        return draw_masks(pil_im, masks)
+
+    # Render each character a timecode can have as masks for its outline and fill, all the same height
+    # and lined up on the same baseline. Returns each one's advance width and masks
+    def render_glyphs(self):
+        from PIL import ImageDraw
+        font = load_font(timecodeSize)
+        draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+        chars = "0123456789:."
+        _, top, _, bottom = draw.textbbox((0, 0), chars, font=font)
+        glyphs = {}
+        for char in chars:
+            advance = draw.textlength(char, font=font)
+            size = (int(advance) + 2 + 2 * timecodeOutline, bottom - top + 2 * timecodeOutline)
+            origin = (timecodeOutline, timecodeOutline - top)
+            outline = Image.new("L", size)
+            ImageDraw.Draw(outline).text(origin, char, font=font, fill=255, stroke_width=timecodeOutline, stroke_fill=255)
+            fill = Image.new("L", size)
+            ImageDraw.Draw(fill).text(origin, char, font=font, fill=255)
+            glyphs[char] = (advance, outline, fill)
+        return glyphs
+
+    # Parse a subtitle file the first time it's needed, and again if it changes
+    def subtitles(self, filename):
+        mtime = os.stat(filename).st_mtime
+        cached = self.subtitleFiles.get(filename)
+        if not cached or cached[0] != mtime:
+            cached = (mtime, Subtitles(filename))
+            self.subtitleFiles[filename] = cached
+        return cached[1]
+
+    # Draw subtitle text centered at the bottom of a frame, white with a black outline
+    def draw_text(self, pil_im, text):
+        if text in self.textCache:
+            self.textCache.move_to_end(text)
+        else:
+            self.textCache[text] = self.render_text(text)
+            if len(self.textCache) > textCacheSize:
+                self.textCache.popitem(last=False)
+        return draw_masks(pil_im, [self.textCache[text]])
+
+    # Render subtitle text as masks for its outline and its fill, wrapped to fit the display.
+    # Returns them with the position to draw them at
+    def render_text(self, text):
+        from PIL import ImageDraw
+        if not self.font:
+            # Like libass, size the font by its line height rather than its em size
+            lineHeight = self.height * subtitleSize
+            font = load_font(max(round(lineHeight), 8))
+            if hasattr(font, "getmetrics"):
+                ascent, descent = font.getmetrics()
+                font = load_font(max(round(lineHeight * lineHeight / (ascent + descent)), 8))
+            self.font = font
+        font = self.font
+        stroke = max(round(self.height * subtitleOutline), 1)
+        draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+        # Wrap long lines at spaces
+        lines = []
+        for line in text.split("\n"):
+            current = ""
+            for word in line.split():
+                candidate = f"{current} {word}" if current else word
+                if current and draw.textlength(candidate, font=font) > self.width * 0.9:
+                    lines.append(current)
+                    candidate = word
+                current = candidate
+            lines.append(current)
+        text = "\n".join(lines)
+
+        left, top, right, bottom = (round(edge) for edge in draw.multiline_textbbox((0, 0), text, font=font, align="center", stroke_width=stroke))
+        size = (max(right - left, 1), max(bottom - top, 1))
+        outline = Image.new("L", size)
+        ImageDraw.Draw(outline).multiline_text((-left, -top), text, font=font, fill=255, align="center", stroke_width=stroke, stroke_fill=255)
+        fill = Image.new("L", size)
+        ImageDraw.Draw(fill).multiline_text((-left, -top), text, font=font, fill=255, align="center")
+        position = ((self.width - size[0]) // 2, self.height - round(self.height * subtitleMargin) - size[1])
+        return position, outline, fill
+
+    # Get a frame from the video's frame store, if it has one with that frame in it
+    def stored_frame(self, video, frame):
+        if self.args.random_frames:
+            return None
+        if not self.frameStore or self.frameStore.filename != video:
+            if self.frameStore:
+                self.frameStore.close()
+            self.frameStore = FrameStore(self, video)
+        return self.frameStore.read(frame)
+
+    # Decode a frame from the video, letterboxed/pillarboxed to fit the display
+    def extract_frame(self, video, frame, keyframe=None):
+        info = self.video_info(video)
+
+        if not self.args.random_frames:
+            # Keep decoding the current video from where the last frame left off
+            if not self.decoder or self.decoder.filename != video:
+                if self.decoder:
+                    self.decoder.close()
+                self.decoder = FrameDecoder(self, video, info)
+            pil_im = self.decoder.read(frame, self.args.increment)
+            if pil_im:
+                return pil_im
+
+        if keyframe is not None:
+            # Seek to just after the keyframe and take the first frame FFmpeg decodes, which is the keyframe itself
+            msTimecode = f"{keyframe * 1000 + info['frame_time'] / 2:.3f}ms"
+        else:
+            msTimecode = self.frame_seek(info, frame)
+
+        # Use ffmpeg to extract a frame from the movie, letterbox/pillarbox it, and stream it into memory
+        return self.generate_frame(video, info, msTimecode, accurate=keyframe is None)
+
+    # Convert, adjust and dither an extracted frame in one pass over its pixels
+    def process_frame(self, pil_im):
+        # Mono frames are already dithered by FFmpeg
+        if pil_im.mode == "1":
+            return pil_im
+
+        args = self.args
+        levels = displayLevels.get(getattr(self.epd, "mode", "bw"))
+        if args.contrast == 1 and args.gamma == 1 and args.levels == [0, 255] and (not levels or args.dither == "none"):
+            # Nothing to adjust, and the display driver will convert the frame itself
+            return pil_im
+
+        pixels = numpy.asarray(pil_im)
+        if levels and pixels.ndim == 3:
+            # Convert to gray with the same weights as PIL's convert("L")
+            pixels = ((pixels @ numpy.array([19595, 38470, 7471], dtype=numpy.uint32) + 0x8000) >> 16).astype(numpy.uint8)
+
+        curve = self.toneCurve
+        if args.contrast != 1:
+            # Same as PIL's ImageEnhance.Contrast: scale each value's distance from the frame's mean gray
+            if pixels.ndim == 3:
+                means = [numpy.bincount(pixels[..., channel].ravel(), minlength=256) @ curve for channel in range(3)]
+                mean = numpy.dot(means, [0.299, 0.587, 0.114]) / (self.width * self.height)
+            else:
+                mean = numpy.bincount(pixels.ravel(), minlength=256) @ curve / (self.width * self.height)
+            mean = int(mean + 0.5)
+            curve = numpy.clip(mean + (curve - mean) * args.contrast, 0, 255)
+
+        if not levels or args.dither == "none":
+            return Image.fromarray(curve.round().astype(numpy.uint8)[pixels])
+
+        if args.dither == "ordered":
+            scale = (levels - 1) / 255
+            shades = numpy.minimum((curve * scale)[pixels] + self.ditherThresholds, levels - 1).astype(numpy.uint8)
+            pil_im = Image.fromarray((shades * (255 // (levels - 1))).astype(numpy.uint8))
+            return pil_im.convert("1", dither=Image.Dither.NONE) if levels == 2 else pil_im
+
+        # Error diffusion can't be vectorized, so leave that part to PIL
+        pil_im = Image.fromarray(curve.round().astype(numpy.uint8)[pixels])
+        if levels == 2:
+            return pil_im.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+        palette = Image.new("P", (1, 1))
+        palette.putpalette([shade * 255 // (levels - 1) for shade in range(levels) for _ in range(3)])
+        return pil_im.convert("RGB").quantize(palette=palette, dither=Image.Dither.FLOYDSTEINBERG).convert("L")
+
+    # Pick which video to play and where in it to start
+    def start(self):
+        args = self.args
+        self.logger.debug("Picking which video to play...")
+
+        # First, try the --file CLI argument...
+        self.logger.debug("...trying the --file argument...")
+        currentVideo = args.file
+
+        # ...then try a random video, if --random-file was selected...
+        if not currentVideo and args.random_file:
+            self.logger.debug("...random-file mode: trying to pick a random video...")
+            currentVideo = self.library.random_video()
+
+        # ...then try the last played video...
+        lastVideo = self.journal.now_playing()
+        if not currentVideo and lastVideo:
+            self.logger.debug("...trying the last played video...")
+            if os.path.isfile(lastVideo):
+                if self.library.contains(lastVideo) or not args.directory:
+                    currentVideo = lastVideo
+            else:
+                self.logger.warning(f"The last played video, '{lastVideo}', couldn't be found")
+
+        # ...then just pick the first video in the videos directory...
+        if not currentVideo:
+            self.logger.debug("...trying to pick the first video in the directory...")
+            currentVideo = self.library.next_video()
+
+        # ...if none of those worked, exit.
+        if not currentVideo:
+            self.logger.critical("No videos found")
+            sys.exit(1)
+
+        self.logger.debug(f"...picked '{currentVideo}'!")
+
+        self.logger.info(f"Update interval: {args.delay}")
+        if not args.random_frames:
+            self.logger.info(f"Frame increment: {args.increment}")
+        if args.pixel_format == "mono" and (args.contrast != 1 or args.gamma != 1 or args.levels != [0, 255] or args.dither != "none"):
+            self.logger.warning("Mono frames are already dithered by FFmpeg, ignoring --contrast, --gamma, --levels and --dither")
+        if args.dither != "none" and getattr(self.epd, "mode", "bw") not in displayLevels:
+            self.logger.warning("Dithering is only done for black and white or grayscale displays, ignoring --dither")
+
+        if not (args.random_file and args.random_frames):
+            # Save the current video
+            self.journal.save_now_playing(os.path.abspath(currentVideo))
+
+        # Carry on with the videos next to one from outside the videos directory
+        if not self.library.contains(currentVideo):
+            self.viddir = os.path.dirname(currentVideo)
+            self.library.close()
+            self.library = VideoLibrary(self.viddir, self.logger)
+        self.load_video(currentVideo)
+
+        # Set up the start position based on CLI input or saved progress if either exists
+        savedFrame = self.journal.frame(self.videoKey, self.videoFilename)
+        if args.random_frames:
+            self.currentFrame, self.keyframe = self.random_frame(self.videoInfo)
+        elif args.start:
+            self.currentFrame = clamp(args.start, 0, self.last_frame(self.videoInfo))
+            self.logger.info(f"Starting at frame {self.currentFrame}")
+        elif savedFrame is not None:
+            self.currentFrame = clamp(savedFrame, 0, self.last_frame(self.videoInfo))
+            self.logger.info(f"Resuming at frame {self.currentFrame}")
+        else:
+            self.currentFrame = 0
+
+    # Make `video` the current video
+    def load_video(self, video):
+        self.check_source(video)
+        self.currentVideo = video
+        self.videoFilename = os.path.basename(video)
+        # Progress is saved under the video's path in the videos directory, as videos in different
+        # folders can have the same name
+        self.videoKey = self.library.relative_path(video) if self.library.contains(video) else self.videoFilename
+        self.videoInfo = self.video_info(video)
+
+    # Forget what's known about a video if it's now to be decoded from a different file: an optimized
+    # copy made since it was loaded, or the video itself if its copy has gone
+    def check_source(self, video):
+        self.sourceChecked = time.monotonic()
+        info = self.videoInfos.get(video)
+        if not info or info["source"] == (self.optimized_copy(video) or video):
+            return
+        del self.videoInfos[video]
+        if self.decoder and self.decoder.filename == video:
+            self.decoder.close()
+            self.decoder = None
+
+    # Display the current frame and move on to the next one
+    def step(self):
+        args = self.args
+        if not self.currentVideo:
+            self.start()
+
+        if self.lastVideo != self.currentVideo:
+            # Print a message when starting a new video
+            self.logger.info(f"Playing '{self.videoFilename}'")
+            self.logger.info(f"Video info: {self.videoInfo['frame_count']} frames, {self.videoInfo['fps']:.3f}fps, duration: {time.strftime('%H:%M:%S', time.gmtime(self.videoInfo['duration']))}")
+            if not args.random_frames:
+                self.logger.info(f"This video will take {estimate_runtime(args.delay, args.increment, self.videoInfo['frame_count'] - self.currentFrame)} to play.")
+
+            self.lastVideo = self.currentVideo
+
+        # Note the time when starting to display, for the timing metrics
+        timeStart = time.perf_counter()
+
+        # Use the frame rendered in the background during the last sleep, if it's still the one we want
+        if self.prefetch and self.prefetch[:2] == (self.currentVideo, self.currentFrame):
+            with self.timer.stage("prefetch_wait"):
+                pil_im = self.prefetch[2].result()
+        else:
+            if self.prefetch:
+                # The stale render is still using the decoder, so let it finish before starting over
+                wait([self.prefetch[2]])
+            pil_im = self.render_frame(self.currentVideo, self.currentFrame, self.keyframe)
+        self.prefetch = None
+
+        # Which frame ends up on the display, for the timing metrics
+        displayed = {"video": None, "frame": None}
+
+        refresh = True
+        if args.skip_similar is not None and pil_im and not args.random_frames:
+            # Skip ahead while the frame looks the same as the one already on the display
+            frameHash = frame_hash(pil_im)
+            skipped = 0
+            while self.lastHash is not None and hash_distance(frameHash, self.lastHash) <= args.skip_similar:
+                if skipped == args.max_skip or self.currentFrame + args.increment > self.last_frame(self.videoInfo):
+                    self.logger.debug(f"Frame {int(self.currentFrame)} still looks like the one on the display, leaving it")
+                    refresh = False
+                    break
+                nextImage = self.render_frame(self.currentVideo, self.currentFrame + args.increment)
+                if not nextImage:
+                    break
+                self.currentFrame += args.increment
+                skipped += 1
+                pil_im = nextImage
+                frameHash = frame_hash(pil_im)
+            if skipped:
+                self.logger.debug(f"Skipped {skipped} similar frame(s)")
+            if refresh:
+                self.lastHash = frameHash
+
+        if refresh and pil_im and self.partialRefresh and not self.partialRefresh.compare(pil_im):
+            self.logger.debug("Frame is unchanged, skipping refresh")
+            refresh = False
+
+        if refresh:
+            with self.timer.stage("prepare"):
+                self.epd.prepare()
+
+            if pil_im:
+                # Display the image
+                self.logger.debug(f"Displaying frame {int(self.currentFrame)} of {self.videoFilename} ({(self.currentFrame/self.videoInfo['frame_count'])*100:.1f}%)")
+                with self.timer.stage("display"):
+                    if self.partialRefresh:
+                        self.partialRefresh.display(pil_im)
+                    else:
+                        self.epd.display(pil_im)
+                displayed = {"video": self.videoFilename, "frame": int(self.currentFrame)}
+            else:
+                self.logger.warning(f"Couldn't extract frame {int(self.currentFrame)} of {self.videoFilename}")
+
+        self.advance()
+
+        if refresh:
+            with self.timer.stage("sleep"):
+                self.epd.sleep()
+
+        # Now there's a frame on the display, index the keyframes of the video that's playing, for the
+        # sequential decoder to seek with. Random frames don't use it (--fast-random builds it on loading)
+        if self.videoInfo["keyframes"] is None and not args.random_frames:
+            self.index_keyframes(self.currentVideo)
+
+        if self.name:
+            displayed["display"] = self.name
+        self.timer.finish(**displayed, total=round(time.perf_counter() - timeStart, 4))
+        if self.frameCache and args.stats_interval and self.timer.count % args.stats_interval == 0:
+            self.frameCache.report()
+
+        # Start rendering the next frame while we wait. Its timings are recorded with the refresh that displays it
+        if self.prefetcher:
+            self.prefetch = (self.currentVideo, self.currentFrame, self.prefetcher.submit(self.render_frame, self.currentVideo, self.currentFrame, self.keyframe))
+
+    # Build a video's keyframe index in the background. Until it's ready, seeking is decided without it
+    def index_keyframes(self, video):
+        if video in self.indexing:
+            return
+        info = self.video_info(video)
+
+        def indexed(future):
+            try:
+                info["keyframes"] = future.result()
+            except Exception as e:
+                self.logger.warning(f"Couldn't index the keyframes of '{os.path.basename(video)}': {e}")
+                info["keyframes"] = []
+            self.indexing.pop(video, None)
+
+        future = self.indexer.submit(keyframe_index, info["source"], info["start_time"], self.progressdir)
+        self.indexing[video] = future
+        future.add_done_callback(indexed)
+
+    # Move to the next frame to display, which may be in the next video
+    def advance(self):
+        args = self.args
+        if time.monotonic() - self.sourceChecked >= libraryPollInterval:
+            # Pick up an optimized copy of the video made since it was loaded
+            self.load_video(self.currentVideo)
+
+        if args.random_frames:
+            if args.random_file:
+                # Pick a new random video
+                self.load_video(self.library.random_video())
+            self.currentFrame, self.keyframe = self.random_frame(self.videoInfo)
+            return
+
+        self.currentFrame += args.increment
+        # If it's the end of the video
+        if self.currentFrame > self.last_frame(self.videoInfo):
+            if args.loop:
+                self.load_video(self.currentVideo)
+            else:
+                if args.random_file:
+                    # Pick a new random video
+                    nextVideo = self.library.random_video()
+                else:
+                    # Update currently playing video to be the next one in the Videos directory
+                    nextVideo = self.library.next_video(self.currentVideo)
 
-def fullscreen_filter(self):
-    if args.fullscreen:
-        if videoInfo["aspect_ratio"] > width / height:
-            return self.filter("crop", f"ih*{width / height}", "ih")
-        elif videoInfo["aspect_ratio"] < width / height:
-            return self.filter("crop", "iw", f"iw*{height / width}")
-    return self
+                # Note the new video
+                self.journal.save_now_playing(os.path.abspath(nextVideo))
 
+                self.load_video(nextVideo)
 
-ffmpeg.Stream.overlay_filter = overlay_filter
-ffmpeg.Stream.fullscreen_filter = fullscreen_filter
+            # Reset frame to 0 (this restarts the same video if looping)
+            self.currentFrame = 0
+
+        # Save the new position
+        with self.timer.stage("progress"):
+            self.journal.save_frame(self.videoKey, self.currentFrame)
+
+    # Stop decoding and shut the display down, clearing it first if `clear` is set
+    def close(self, clear=False):
+        # Save progress first, in case anything below fails
+        self.journal.close()
+        # Drop background work that hasn't started. Executor.shutdown can only do this from Python 3.9
+        if self.prefetch:
+            self.prefetch[2].cancel()
+        for future in list(self.indexing.values()):
+            future.cancel()
+        if self.prefetcher and not self.sharedPool:
+            self.prefetcher.shutdown(wait=False)
+        self.indexer.shutdown(wait=False)
+        if self.decoder:
+            self.decoder.close()
+        if self.frameStore:
+            self.frameStore.close()
+        if self.frameCache and self.frameCache.hits + self.frameCache.misses:
+            self.frameCache.report()
+        self.library.close()
+        if clear:
+            self.epd.prepare()
+            self.epd.clear()
+        self.epd.close()
 
 
 # Used by configargparse to check that a file exists and is a compatible video
@@ -112,69 +1759,418 @@ def supported_filetype(file):
 
 
 # Get framerate, frame count, duration, and frame-time of video via FFmpeg probe
-def video_info(file):
-    if file in videoInfos:
-        info = videoInfos[file]
-    else:
-        probeInfo = ffmpeg.probe(file, select_streams="v")
-        stream = probeInfo["streams"][0]
+def probe_video(file):
+    from fractions import Fraction
+    probeInfo = ffmpeg.probe(file, select_streams="v")
+    stream = probeInfo["streams"][0]
 
-        # Calculate framerate
-        avg_fps = stream["avg_frame_rate"]
-        fps = float(Fraction(avg_fps))
+    # Calculate framerate
+    avg_fps = stream["avg_frame_rate"]
+    fps = float(Fraction(avg_fps))
 
-        # Calculate duration
-        duration = float(probeInfo["format"]["duration"])
+    # Calculate duration
+    duration = float(probeInfo["format"]["duration"])
 
-        # Either get frame count or calculate it
-        try:
-            # Get frame count for .mp4s
-            frameCount = int(stream["nb_frames"])
-        except KeyError:
-            # Calculate frame count for .mkvs (and maybe other formats?)
-            frameCount = int(duration * fps)
+    # Either get frame count or calculate it
+    try:
+        # Get frame count for .mp4s
+        frameCount = int(stream["nb_frames"])
+    except KeyError:
+        # Calculate frame count for .mkvs (and maybe other formats?)
+        frameCount = int(duration * fps)
 
-        # Calculate frametime (ms each frame is displayed)
-        frameTime = 1000 / fps
+    # Calculate frametime (ms each frame is displayed)
+    frameTime = 1000 / fps
 
-        subtitle_file = find_subtitles(file)
-        aspect_ratio = int(stream["width"]) / int(stream["height"])
+    # Frame size as shown: FFmpeg rotates videos with rotation metadata (e.g. from phones) when decoding
+    width, height = int(stream["width"]), int(stream["height"])
+    try:
+        sar = float(Fraction(stream.get("sample_aspect_ratio", "1:1").replace(":", "/")))
+    except (ValueError, ZeroDivisionError):
+        sar = 0
+    sar = sar or 1.0
+    rotation = int(float(stream.get("tags", {}).get("rotate", 0)))
+    for sideData in stream.get("side_data_list", []):
+        rotation = int(float(sideData.get("rotation", rotation)))
+    if rotation % 180:
+        width, height, sar = height, width, 1 / sar
+
+    # Shape of the picture, allowing for non-square pixels
+    aspect_ratio = width * sar / height
+
+    return {
+        "frame_count": frameCount,
+        "fps": fps,
+        "duration": duration,
+        "frame_time": frameTime,
+        "aspect_ratio": aspect_ratio,
+        "width": width,
+        "height": height,
+        "sar": sar,
+        "start_time": float(probeInfo["format"].get("start_time", 0)),
+        "codec": stream.get("codec_name")}
+
+
+# The list of optimized copies: which video each was made from, and when it was last changed
+def load_manifest():
+    try:
+        with open(optimizedManifest) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_manifest(name, entry):
+    entries = load_manifest()
+    entries[name] = entry
+    # Forget copies that have gone
+    entries = {name: entry for name, entry in entries.items() if os.path.isfile(os.path.join(optimizedDir, name))}
+    with open(f"{optimizedManifest}.tmp", "w") as manifest:
+        json.dump(entries, manifest, indent=1)
+    os.replace(f"{optimizedManifest}.tmp", optimizedManifest)
+
+
+# Optimize the players' videos, then keep optimizing any that are added or changed until stopped
+def optimize_library(players):
+    # Leave the CPU to anything else that needs it, such as a player
+    os.nice(19)
+    # Videos that couldn't be optimized, with their modification time and size. They're tried again
+    # once they change (e.g. when a half-copied video has finished copying)
+    failed = {}
+    while True:
+        for player in players:
+            videos = [player.args.file] if player.args.file else player.library.paths()
+            for video in videos:
+                try:
+                    stat = os.stat(video)
+                except OSError:
+                    continue
+                if failed.get(video) == (stat.st_mtime, stat.st_size):
+                    continue
+                try:
+                    optimized = player.optimize(video)
+                except OSError as e:
+                    player.logger.error(f"Couldn't optimize '{os.path.basename(video)}': {e}")
+                    optimized = False
+                if optimized:
+                    failed.pop(video, None)
+                else:
+                    failed[video] = (stat.st_mtime, stat.st_size)
+        if failed:
+            logger.info(f"All videos are optimized except {len(failed)} that couldn't be, waiting for new ones")
+        else:
+            logger.info("All videos are optimized, waiting for new ones")
+        time.sleep(libraryPollInterval)
 
-        info = {
-            "frame_count": frameCount,
-            "fps": fps,
-            "duration": duration,
-            "frame_time": frameTime,
-            "subtitle_file": subtitle_file,
-            "aspect_ratio": aspect_ratio}
 
-        videoInfos[file] = info
-    return info
+# What went wrong for an ffmpeg.Error: the last line FFmpeg or FFprobe printed
+def ffmpeg_message(e):
+    lines = e.stderr.decode(errors="replace").strip().splitlines() if e.stderr else []
+    return lines[-1] if lines else str(e)
 
 
-# Returns the next video in the videos directory, or the first one if there's no current video
-def get_next_video(viddir, currentVideo=None):
-    # Only consider videos in the directory
-    videos = sorted(list(filter(supported_filetype, os.listdir(viddir))))
+# Probe a video, find its subtitles and build its keyframe index (and its frame timestamp table with
+# `frameExact`), for --index. Runs in a worker
+# process, so FFmpeg's errors (which can't be sent back from one) are passed on as RuntimeErrors
+def index_video(source, file, progressdir, frameExact=False):
+    try:
+        stat = os.stat(source)
+        info = probe_video(source)
+        keyframes = keyframe_index(source, info["start_time"], progressdir)
+        if frameExact:
+            frame_times(source, info["start_time"], progressdir)
+    except ffmpeg.Error as e:
+        raise RuntimeError(ffmpeg_message(e)) from None
+    return {
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "version": probeVersion,
+        "info": info,
+        "subtitle_file": find_subtitles(file),
+        "subtitle_dir_mtime": os.stat(os.path.dirname(os.path.abspath(file))).st_mtime,
+        "keyframe_count": len(keyframes)}
+
+
+# Ignore Ctrl+C in --index's worker processes, leaving the main process to stop them
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+# Index the players' videos using every CPU core, then log what's in each video and how long they'll take to play
+def index_library(players):
+    pool = concurrent.futures.ProcessPoolExecutor(initializer=ignore_interrupts)
+    try:
+        for player in players:
+            entries = player.index(pool)
+            args = player.args
+            totalFrames = 0
+            for video, entry in entries.items():
+                info = entry["info"]
+                totalFrames += info["frame_count"]
+                keyframes = f"a keyframe every {info['duration'] / entry['keyframe_count']:.1f}s" if entry["keyframe_count"] else "no keyframes"
+                subtitles = ", subtitles" if entry["subtitle_file"] else ""
+                seconds = round(info["duration"])
+                player.logger.info(
+                    f"'{os.path.basename(video)}': {info['frame_count']} frames at {info['fps']:.3f} fps ({seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}), "
+                    f"{info['aspect_ratio']:.2f}:1, {keyframes}{subtitles}; takes {estimate_runtime(args.delay, args.increment, info['frame_count'])} to play")
+            player.logger.info(f"{len(entries)} videos, {totalFrames} frames: the library takes {estimate_runtime(args.delay, args.increment, totalFrames, all=True)} to play")
+    finally:
+        pool.shutdown()
 
-    # Return None if there are no videos
-    if not videos:
-        return None
 
-    if currentVideo:
-        nextIndex = videos.index(currentVideo) + 1
-        # If we're not wrapping around
-        if not nextIndex >= len(videos):
-            return os.path.join(viddir, videos[nextIndex])
-    # Wrapping around or no current video: return first video
-    return os.path.join(viddir, videos[0])
+# Names of the decoders this FFmpeg build has
+@functools.lru_cache(maxsize=None)
+def ffmpeg_decoders():
+    try:
+        output = subprocess.run(["ffmpeg", "-hide_banner", "-decoders"], capture_output=True, text=True).stdout
+    except OSError:
+        return set()
+    # Decoders are listed after a "------" line, as capability flags followed by the name
+    _, _, listing = output.partition("------")
+    return {line.split()[1] for line in listing.splitlines() if len(line.split()) > 1}
+
+
+# Whether the FFmpeg decoder called `decoder` decodes `codec`: one of the codec's hardware decoders,
+# or named after the codec (e.g. h264 and h264_cuvid for h264, libvpx-vp9 for vp9)
+def decoder_for(decoder, codec):
+    return decoder in hardwareDecoders.get(codec, []) or codec in re.split(r"[_-]", decoder)
+
 
+# Whether the hardware behind an FFmpeg hardware decoder is there to use
+def hardware_present(decoder):
+    if decoder.endswith("_v4l2m2m"):
+        return bool(glob.glob("/dev/video*"))
+    if decoder.endswith("_mmal"):
+        return os.path.exists("/dev/vchiq")
+    return True
+
+
+# An inotify instance for watching directories, or None where there's no inotify (not Linux, or
+# out of instances)
+def inotify_init():
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return libc, fd
+
+
+# The videos in a directory and its subdirectories, sorted by their path within it. The directory is
+# scanned when the list is first needed, then kept up to date by inotify, or where that isn't
+# available by checking each directory's modification time every so often, so picking the next
+# video doesn't mean listing a large library again
+class VideoLibrary:
+    def __init__(self, directory, log=None):
+        self.directory = directory
+        self.logger = log or logger
+        # Relative paths of the videos
+        self.videos = []
+        # Modification time, videos and subdirectories of each directory, by relative path
+        self.contents = {}
+        # Directory watched by each inotify watch descriptor
+        self.watches = {}
+        self.inotify = None
+        self.lastPoll = None
+
+    # Path of the next video after `current`, wrapping around to the first, or the first video if
+    # there's no current one. `current` doesn't need to still be there
+    def next_video(self, current=None):
+        self.refresh()
+        if not self.videos:
+            return None
+        index = 0
+        if current and self.contains(current):
+            index = bisect.bisect_right(self.videos, self.relative_path(current)) % len(self.videos)
+        return os.path.join(self.directory, self.videos[index])
+
+    # Path of a random video
+    def random_video(self):
+        self.refresh()
+        if self.videos:
+            return os.path.join(self.directory, random.choice(self.videos))
+
+    # Paths of all the videos, in order
+    def paths(self):
+        self.refresh()
+        return [os.path.join(self.directory, video) for video in self.videos]
+
+    # Whether a path is inside the directory
+    def contains(self, path):
+        relative = self.relative_path(path)
+        return relative != os.pardir and not relative.startswith(os.pardir + os.sep)
+
+    def relative_path(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.directory))
+
+    # Bring the list up to date
+    def refresh(self):
+        if self.lastPoll is None:
+            self.inotify = inotify_init()
+            self.lastPoll = time.monotonic()
+            self.scan("")
+            if self.inotify:
+                self.logger.debug(f"Found {len(self.videos)} videos in '{self.directory}', watching it for changes")
+            else:
+                self.logger.debug(f"Found {len(self.videos)} videos in '{self.directory}', checking it for changes every {libraryPollInterval} seconds")
+        elif self.inotify:
+            self.read_events()
+        elif time.monotonic() - self.lastPoll >= libraryPollInterval:
+            self.lastPoll = time.monotonic()
+            self.poll()
+
+    # List a directory, and any subdirectories that are new, updating the list of videos from it
+    def scan(self, reldir):
+        path = os.path.join(self.directory, reldir)
+        try:
+            mtime = os.stat(path).st_mtime
+            entries = list(os.scandir(path))
+        except OSError:
+            self.forget(reldir)
+            return
+        self.watch(reldir)
+
+        videos = set()
+        subdirs = set()
+        for entry in entries:
+            name = os.path.join(reldir, entry.name)
+            try:
+                if entry.name.startswith("."):
+                    continue
+                elif entry.is_dir():
+                    # Don't follow symlinks back up the tree
+                    if not os.path.join(os.path.realpath(path), "").startswith(os.path.join(os.path.realpath(entry.path), "")):
+                        subdirs.add(name)
+                elif supported_filetype(entry.name):
+                    videos.add(name)
+            except OSError:
+                continue
+
+        _, oldVideos, oldSubdirs = self.contents.get(reldir, (None, set(), set()))
+        self.contents[reldir] = (mtime, videos, subdirs)
+        for video in oldVideos - videos:
+            self.remove(video)
+        for video in videos - oldVideos:
+            self.add(video)
+        for subdir in oldSubdirs - subdirs:
+            self.forget(subdir)
+        for subdir in subdirs - oldSubdirs:
+            self.scan(subdir)
+
+    # Drop a directory that's gone, and everything in it
+    def forget(self, reldir):
+        mtime, videos, subdirs = self.contents.pop(reldir, (None, set(), set()))
+        if self.inotify:
+            libc, fd = self.inotify
+            for wd in [wd for wd, watched in self.watches.items() if watched == reldir]:
+                libc.inotify_rm_watch(fd, wd)
+                del self.watches[wd]
+        for video in videos:
+            self.remove(video)
+        for subdir in subdirs:
+            self.forget(subdir)
+
+    def add(self, video):
+        index = bisect.bisect_left(self.videos, video)
+        if index == len(self.videos) or self.videos[index] != video:
+            self.videos.insert(index, video)
+
+    def remove(self, video):
+        index = bisect.bisect_left(self.videos, video)
+        if index < len(self.videos) and self.videos[index] == video:
+            del self.videos[index]
+
+    # Start getting inotify events for a directory. If it can't be watched (e.g. the limit on
+    # watches has been reached), switch to polling
+    def watch(self, reldir):
+        if not self.inotify:
+            return
+        libc, fd = self.inotify
+        wd = libc.inotify_add_watch(fd, os.fsencode(os.path.join(self.directory, reldir)), inotifyMask)
+        if wd < 0:
+            import ctypes
+            self.logger.warning(f"Can't watch '{os.path.join(self.directory, reldir)}' for changes ({os.strerror(ctypes.get_errno())}), checking every {libraryPollInterval} seconds instead")
+            self.close()
+            return
+        self.watches[wd] = reldir
+
+    # Apply the changes inotify has reported since last time
+    def read_events(self):
+        libc, fd = self.inotify
+        data = b""
+        try:
+            while True:
+                data += os.read(fd, 65536)
+        except BlockingIOError:
+            pass
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Too many changes at once to keep track of: list everything again
+                self.logger.debug(f"Too many changes in '{self.directory}', listing it again")
+                self.videos, self.contents, self.watches = [], {}, {}
+                self.scan("")
+                return
+            reldir = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if reldir is None or reldir not in self.contents or not name or name.startswith("."):
+                continue
+
+            mtime, videos, subdirs = self.contents[reldir]
+            path = os.path.join(reldir, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    subdirs.add(path)
+                    self.scan(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    subdirs.discard(path)
+                    self.forget(path)
+            elif supported_filetype(name):
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO) or mask & IN_CREATE and self.is_link(path):
+                    videos.add(path)
+                    self.add(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    videos.discard(path)
+                    self.remove(path)
+
+    # Whether a new file is a symlink or a hard link to an existing file. Links are complete when
+    # they're created, so there won't be a close after writing to wait for
+    def is_link(self, video):
+        path = os.path.join(self.directory, video)
+        try:
+            return os.path.islink(path) or os.lstat(path).st_nlink > 1
+        except OSError:
+            return False
+
+    # List any directories that have changed since they were last listed
+    def poll(self):
+        for reldir in list(self.contents):
+            if reldir not in self.contents:
+                # Already dropped along with its parent
+                continue
+            try:
+                changed = os.stat(os.path.join(self.directory, reldir)).st_mtime != self.contents[reldir][0]
+            except OSError:
+                changed = True
+            if changed:
+                self.scan(reldir)
 
-# Returns a random video from the videos directory
-def get_random_video(viddir):
-    videos = list(filter(supported_filetype, os.listdir(viddir)))
-    if videos:
-        return os.path.join(viddir, random.choice(videos))
+    # Stop watching for changes
+    def close(self):
+        if self.inotify:
+            os.close(self.inotify[1])
+            self.inotify = None
+            self.watches = {}
 
 
 # Calculate how long it'll take to play a video.
@@ -200,15 +2196,100 @@ def estimate_runtime(delay, increment, frames, all=False):
     return output
 
 
+# Paths for a video's `suffix` file in the progress directory, the one to write to first. Videos with
+# the same name in different folders are told apart by a hash of their path. Older versions used
+# just the name, and those files are still read when they were made for the same path
+def state_paths(progressdir, file, suffix):
+    name = os.path.basename(file)
+    pathHash = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()[:8]
+    return [os.path.join(progressdir, f"{name}-{pathHash}{suffix}"), os.path.join(progressdir, f"{name}{suffix}")]
+
+
+# Load the keyframe timestamps of a video from the progress directory, or build them with FFprobe.
+# The index is rebuilt if the video's path, modification time or size has changed
+def keyframe_index(file, startTime, progressdir, build=True):
+    indexfiles = state_paths(progressdir, file, ".keyframes")
+    stat = os.stat(file)
+    key = {"path": os.path.abspath(file), "mtime": stat.st_mtime, "size": stat.st_size}
+
+    for indexfile in indexfiles:
+        try:
+            with open(indexfile) as log:
+                index = json.load(log)
+            if all(index.get(k) == v for k, v in key.items()):
+                return index["keyframes"]
+        except (OSError, ValueError, KeyError):
+            pass
+    if not build:
+        return None
+
+    logger.info(f"Building keyframe index for '{os.path.basename(file)}'")
+    probeInfo = ffmpeg.probe(file, select_streams="v:0", show_entries="packet=pts_time,flags")
+    keyframes = sorted(
+        round(float(packet["pts_time"]) - startTime, 6)
+        for packet in probeInfo.get("packets", [])
+        if "K" in packet.get("flags", "") and packet.get("pts_time", "N/A") != "N/A")
+
+    with open(indexfiles[0], "w") as log:
+        json.dump({**key, "keyframes": keyframes}, log)
+    return keyframes
+
+
+# Load the timestamp of every frame of a video, for --frame-exact, from the progress directory, or
+# build the table with FFprobe. Times are in seconds from the start of the video, in the order frames
+# are shown. The table is rebuilt if the video's path, modification time or size has changed
+def frame_times(file, startTime, progressdir, build=True):
+    tablefiles = state_paths(progressdir, file, ".pts")
+    stat = os.stat(file)
+    key = {"path": os.path.abspath(file), "mtime": stat.st_mtime, "size": stat.st_size}
+
+    for tablefile in tablefiles:
+        try:
+            with open(f"{tablefile}.json") as log:
+                header = json.load(log)
+            count = header.pop("count")
+            if header == key:
+                times = numpy.fromfile(tablefile, dtype="<f8")
+                if len(times) == count:
+                    return times
+        except (OSError, ValueError, KeyError):
+            pass
+    if not build:
+        return None
+
+    logger.info(f"Building frame timestamp table for '{os.path.basename(file)}'")
+    # Packets the decoder throws away (e.g. before the start of an edit list) aren't shown
+    probeInfo = ffmpeg.probe(file, select_streams="v:0", show_entries="packet=pts_time,flags")
+    packets = [packet for packet in probeInfo.get("packets", []) if "D" not in packet.get("flags", "")]
+    if all(packet.get("pts_time", "N/A") != "N/A" for packet in packets):
+        times = [float(packet["pts_time"]) for packet in packets]
+    else:
+        # Some containers (e.g. AVI) don't have a timestamp for every packet, so decode the video to find them
+        probeInfo = ffmpeg.probe(file, select_streams="v:0", show_entries="frame=best_effort_timestamp_time")
+        times = [float(frame["best_effort_timestamp_time"]) for frame in probeInfo.get("frames", []) if frame.get("best_effort_timestamp_time", "N/A") != "N/A"]
+    times = numpy.round(numpy.sort(numpy.array(times, dtype="<f8")) - startTime, 6)
+
+    tablefile = tablefiles[0]
+    times.tofile(f"{tablefile}.tmp")
+    os.replace(f"{tablefile}.tmp", tablefile)
+    with open(f"{tablefile}.json", "w") as log:
+        json.dump({**key, "count": len(times)}, log)
+    return times
+
+
+# Time of the last keyframe at or before `time`, in seconds
+def keyframe_before(keyframes, time):
+    return keyframes[max(bisect.bisect_right(keyframes, time) - 1, 0)]
+
+
 # Check for a matching subtitle file
 def find_subtitles(file):
-    if args.subtitles:
-        name, _ = os.path.splitext(file)
-        for i in glob.glob(name + ".*"):
-            _, ext = os.path.splitext(i)
-            if ext.lower() in subtitle_fileTypes:
-                logger.debug(f"Found subtitle file '{i}'")
-                return i
+    name, _ = os.path.splitext(file)
+    for i in glob.glob(name + ".*"):
+        _, ext = os.path.splitext(i)
+        if ext.lower() in subtitle_fileTypes:
+            logger.debug(f"Found subtitle file '{i}'")
+            return i
     return None
 
 
@@ -218,17 +2299,8 @@ class ArgparseLogger(configargparse.ArgumentParser):
         sys.exit(1)
 
 
-# Set up logging
 logger = logging.getLogger()
 
-fileHandler = logging.FileHandler("slowmovie.log")
-fileHandler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)-8s: %(module)s : %(message)s"))
-logger.addHandler(fileHandler)
-
-consoleHandler = logging.StreamHandler(sys.stdout)
-consoleHandler.setFormatter(logging.Formatter("%(levelname)s:%(module)s:%(message)s"))
-logger.addHandler(consoleHandler)
-
 # parse config or CLI arguments
 parser = ArgparseLogger(default_config_files=["slowmovie.conf"])
 parser.add_argument("-f", "--file", type=check_vid, help="video file to start playing; otherwise play the first file in the videos directory")
@@ -236,205 +2308,373 @@ parser.add_argument("-D", "--directory", type=check_dir, help="directory contain
 parser.add_argument("-l", "--loop", action="store_true", help="loop a single video; otherwise play through the files in the videos directory")
 parser.add_argument("-R", "--random-file", action="store_true", help="play files in a random order; otherwise play them in directory order")
 parser.add_argument("-o", "--loglevel", default="INFO", type=str.upper, choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="minimum importance-level of messages displayed and saved to the logfile (default: %(default)s)")
+parser.add_argument("--displays", metavar="FILE", help="drive several displays from one process, each set up by a section of this INI file; frames for all of them are rendered in the background")
+parser.add_argument("--workers", default=2, type=int, help="with --displays, how many frames can be rendered at once (default: %(default)s)")
 
 # frame update controls
 argsControl = parser.add_argument_group("Frame Update Args", "arguments that control frame updates and display")
 argsControl.add_argument("-r", "--random-frames", action="store_true", help="choose a random frame every refresh")
+argsControl.add_argument("--fast-random", action="store_true", help="with --random-frames, only choose keyframes, which are much quicker to seek to")
 argsControl.add_argument("-d", "--delay", default=120, type=int, help="delay in seconds between screen updates (default: %(default)s)")
+argsControl.add_argument("--align", type=int, metavar="SECONDS", help="refresh at multiples of SECONDS by the clock, e.g. 60 to refresh on the minute; the delay is rounded up to the next multiple")
 argsControl.add_argument("-i", "--increment", default=4, type=int, help="advance INCREMENT frames each refresh (default: %(default)s)")
 argsControl.add_argument("-s", "--start", type=int, help="start playing at a specific frame")
+argsControl.add_argument("--save-interval", default=300, type=int, metavar="SECONDS", help="how often to save how far playback has got; it's also saved on exit, and at most this much is lost to a power cut (default: %(default)s)")
+argsControl.add_argument("-P", "--prefetch", action="store_true", help="render the next frame in the background while waiting for the next refresh")
+argsControl.add_argument("--frame-exact", action="store_true", help="find frames by their real timestamps, read once per video into the progress directory, so every frame of variable frame rate videos (e.g. from phones) is shown exactly once; each video takes longer to start the first time")
+argsControl.add_argument("--fast-decode", action="store_true", help="let FFmpeg's software decoder skip detail the display can't show: decode at a lower resolution where the codec allows (e.g. MPEG-4 Part 2, MPEG-2, MJPEG) and skip H.264/HEVC deblocking when frames are shrunk by half or more")
+argsControl.add_argument("--decoder", default="auto", metavar="{auto,software,DECODER}", help="FFmpeg decoder to use: auto uses a hardware decoder (e.g. h264_v4l2m2m) when there's one for the video's codec, software never does, or name a decoder to try it on videos of its codec; if a hardware or named decoder fails on a video, that video falls back to software (default: %(default)s)")
+argsControl.add_argument("--prerender", action="store_true", help="render every INCREMENTth frame of the videos (or just --file) to a frame store in the progress directory, then exit; stored frames play without any decoding")
+argsControl.add_argument("--index", action="store_true", help="probe the videos (or just --file) and index their keyframes using every CPU core, saving the results in the progress directory, then print how long each video and the whole library will take to play, and exit")
+argsControl.add_argument("--frame-cache", type=int, metavar="MB", help="keep up to MB of the most recently rendered frames in memory, so frames shown again (e.g. with --loop or --random-frames) aren't decoded again; 0 disables (default: 32 with --loop or --random-frames, otherwise 0)")
+argsControl.add_argument("--frame-cache-disk", default=0, type=int, metavar="MB", help="also keep up to MB of rendered frames as PNG files in the progress directory, which last between runs (default: %(default)s)")
+argsControl.add_argument("--optimize", action="store_true", help="at low priority, make copies of the videos (or just --file) that are quicker to decode and seek in, sized for the display, then keep watching for new videos; playback uses the copies once they're made")
+argsControl.add_argument("--skip-similar", type=int, metavar="DISTANCE", help="skip ahead past frames whose perceptual hash is within DISTANCE bits (0-64) of the frame on the display; doesn't apply to --random-frames")
+argsControl.add_argument("--max-skip", default=10, type=int, help="with --skip-similar, skip ahead at most MAX_SKIP increments before leaving the display as it is (default: %(default)s)")
 argsControl.add_argument("-F", "--fullscreen", action="store_true", help="expand image to fill display")
 textOverlayGroup = argsControl.add_mutually_exclusive_group()
-textOverlayGroup.add_argument("-S", "--subtitles", action="store_true", help="display SRT subtitles")
+textOverlayGroup.add_argument("-S", "--subtitles", action="store_true", help="display SRT or SSA/ASS subtitles")
 textOverlayGroup.add_argument("-t", "--timecode", action="store_true", help="display video timecode")
 
+# timing controls
+argsTiming = parser.add_argument_group("Timing Args", "arguments to measure how long each stage of a refresh takes")
+argsTiming.add_argument("--stats-interval", default=0, type=int, metavar="N", help="log p50/p95/max timings of each refresh stage every N refreshes; 0 disables (default: %(default)s)")
+argsTiming.add_argument("--stats-window", default=100, type=int, metavar="N", help="number of recent refreshes the timing statistics cover (default: %(default)s)")
+argsTiming.add_argument("--metrics-file", help="append the stage timings of every refresh to this file as JSON lines")
+
 # epd controls
 argsEpd = parser.add_argument_group("EPD Args", "arguments to select and modify the e-Ink display")
 argsEpd.add_argument("-e", "--epd", help="the name of the display device driver to use")
 argsEpd.add_argument("-c", "--contrast", default=1.0, type=float, help="adjust image contrast (default: %(default)s)")
+argsEpd.add_argument("-g", "--gamma", default=1.0, type=float, help="adjust image gamma; higher values brighten mid-tones (default: %(default)s)")
+argsEpd.add_argument("-L", "--levels", default=[0, 255], type=int, nargs=2, metavar=("BLACK", "WHITE"), help="stretch the range between these input levels to full black and white (default: 0 255)")
+argsEpd.add_argument("--dither", default="none", choices=["none", "ordered", "diffusion"], help="dither frames to the display's gray levels before sending them; otherwise the display driver converts them (default: %(default)s)")
 argsEpd.add_argument("-C", "--clear", action="store_true", help="clear display on exit")
+argsEpd.add_argument("--partial-refresh", type=float, metavar="FRACTION", help="use a partial refresh when the changed area of a frame is at most this fraction of the display, if the display is black and white, supports it and has no omni-epd rotate, flip or image settings")
+argsEpd.add_argument("--full-refresh-every", default=10, type=int, metavar="N", help="with --partial-refresh, do a full refresh after N partial ones to clear ghosting (default: %(default)s)")
+argsEpd.add_argument("-p", "--pixel-format", default="rgb", choices=pixelFormats.keys(), help="pixel format to extract frames in; gray or mono suit black and white displays (default: %(default)s)")
+
+
+# Monotonic time of the refresh after one due at `previous`: `delay` seconds later, moved on to the
+# next multiple of `align` seconds by the local clock if aligning. Working each one out from the
+# previous deadline, rather than from when a refresh finished, keeps refreshes from drifting
+def next_deadline(previous, delay, align=None):
+    deadline = previous + delay
+    if align:
+        clock = time.time() + time.localtime().tm_gmtoff + deadline - time.monotonic()
+        # Allow for the clocks not quite agreeing when the deadline was already on a multiple
+        offset = clock % align
+        deadline += -offset if offset < min(0.5, align / 2) else align - offset
+    return deadline
+
+
+# Refresh each player at its deadlines until stopped by a signal, or after `refreshes` refreshes if
+# given. Refreshes run one at a time in a worker thread, so the event loop stays free to handle
+# signals, and displays are shut down from here rather than from inside a signal handler
+async def play(players, refreshes=None):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    stopSignal = None
+
+    def request_stop(signum):
+        nonlocal stopSignal
+        if stopSignal is not None:
+            return
+        logger.info("Exiting Program")
+        stopSignal = signum
+        stop.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, request_stop, signum)
+
+    stepper = ThreadPoolExecutor(max_workers=1)
+    refreshCount = 0
+
+    async def run(player):
+        nonlocal refreshCount
+        delay = player.args.delay
+        deadline = next_deadline(time.monotonic(), 0, player.args.align)
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), max(deadline - time.monotonic(), 0))
+            if stop.is_set():
+                return
+            if refreshes is not None and refreshCount >= refreshes:
+                stop.set()
+                return
+            refreshCount += 1
+            await loop.run_in_executor(stepper, player.step)
+
+            deadline = next_deadline(deadline, delay, player.args.align)
+            if deadline < time.monotonic():
+                # Running behind (e.g. a refresh took longer than the delay): refresh straight away
+                # or at the next aligned time, rather than trying to catch up
+                deadline = next_deadline(time.monotonic(), 0, player.args.align)
 
-args = parser.parse_args()
-
-# Set log level
-logger.setLevel(getattr(logging, args.loglevel))
-
-# Set up e-Paper display - do this first since we can't do much if it fails
-try:
-    epd = displayfactory.load_display_driver(args.epd)
-except EPDNotFoundError:
-    # EPD not found, give a list of supported displays
-    validEpds = displayfactory.list_supported_displays()
-
-    logger.error(f"'{args.epd}' is not a valid EPD name, valid names are:")
-    logger.error("\n".join(map(str, validEpds)))
-
-    # can't get past this
-    sys.exit(1)
-
-# set width and height
-width = epd.width
-height = epd.height
-
-# Set path of Videos directory and logs directory. Videos directory can be specified by CLI --directory
-if args.directory:
-    viddir = args.directory
-else:
-    viddir = "Videos"
-progressdir = "progress"
-
-# Create progress and Videos directories if missing
-if not os.path.isdir(progressdir):
-    os.mkdir(progressdir)
-if not os.path.isdir(viddir):
-    os.mkdir(viddir)
-
-# Pick which video to play
-logger.debug("Picking which video to play...")
-
-# First, try the --file CLI argument...
-logger.debug("...trying the --file argument...")
-currentVideo = args.file
-
-# ...then try a random video, if --random-file was selected...
-if not currentVideo and args.random_file:
-    logger.debug("...random-file mode: trying to pick a random video...")
-    currentVideo = get_random_video(viddir)
-
-# ...then try the nowPlaying file, which stores the last played video...
-if not currentVideo and os.path.isfile("nowPlaying"):
-    logger.debug("...trying the video in the nowPlaying file...")
-    with open("nowPlaying") as file:
-        lastVideo = os.path.abspath(file.readline().strip())
-    if os.path.isfile(lastVideo):
-        if os.path.dirname(lastVideo) == os.path.abspath(viddir) or not args.directory:
-            currentVideo = lastVideo
-    else:
-        logger.warning(f"'{lastVideo}' read from nowPlaying file couldn't be found. Removing nowPlaying directory for recreation.")
-        os.remove("nowPlaying")
-
-# ...then just pick the first video in the videos directory...
-if not currentVideo:
-    logger.debug("...trying to pick the first video in the directory...")
-    currentVideo = get_next_video(viddir)
-
-# ...if none of those worked, exit.
-if not currentVideo:
-    logger.critical("No videos found")
-    sys.exit(1)
-
-logger.debug(f"...picked '{currentVideo}'!")
-
-logger.info(f"Update interval: {args.delay}")
-if not args.random_frames:
-    logger.info(f"Frame increment: {args.increment}")
-
-if not (args.random_file and args.random_frames):
-    # Write the current video to the nowPlaying file
-    with open("nowPlaying", "w") as file:
-        file.write(os.path.abspath(currentVideo))
-
-videoFilename = os.path.basename(currentVideo)
-viddir = os.path.dirname(currentVideo)
-
-progressfile = os.path.join(progressdir, f"{videoFilename}.progress")
-
-videoInfos = {}
-videoInfo = video_info(currentVideo)
-
-# Set up the start position based on CLI input or progressfiles if either exists
-if not args.random_frames:
-    if args.start:
-        currentFrame = clamp(args.start, 0, videoInfo["frame_count"])
-        logger.info(f"Starting at frame {currentFrame}")
-    elif (os.path.isfile(progressfile)):
-        # Read current frame from progressfile
-        with open(progressfile) as log:
-            try:
-                currentFrame = int(log.readline())
-                currentFrame = clamp(currentFrame, 0, videoInfo["frame_count"])
-                logger.info(f"Resuming at frame {currentFrame}")
-            except ValueError:
-                currentFrame = 0
-    else:
-        currentFrame = 0
+    try:
+        await asyncio.gather(*(run(player) for player in players))
+    finally:
+        # Signals are still handled (and ignored) here, so a second Ctrl-C doesn't interrupt shutting down
+        stepper.shutdown()
+        for player in players:
+            player.close(player.args.clear and stopSignal is not None)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
 
-# Initialize lastVideo so that first time through the loop, we'll print "Playing x"
-lastVideo = None
 
-while True:
-    if lastVideo != currentVideo:
-        # Print a message when starting a new video
-        logger.info(f"Playing '{videoFilename}'")
-        logger.info(f"Video info: {videoInfo['frame_count']} frames, {videoInfo['fps']:.3f}fps, duration: {time.strftime('%H:%M:%S', time.gmtime(videoInfo['duration']))}")
-        if not args.random_frames:
-            logger.info(f"This video will take {estimate_runtime(args.delay, args.increment, videoInfo['frame_count'] - currentFrame)} to play.")
+# Load the display driver called `name`, exiting with a list of valid names if there isn't one
+def load_display(name):
+    from omni_epd import displayfactory, EPDNotFoundError
+    try:
+        return displayfactory.load_display_driver(name)
+    except EPDNotFoundError:
+        # EPD not found, give a list of supported displays
+        validEpds = displayfactory.list_supported_displays()
 
-        lastVideo = currentVideo
+        logger.error(f"'{name}' is not a valid EPD name, valid names are:")
+        logger.error("\n".join(map(str, validEpds)))
 
-    # Note the time when starting to display so later we can sleep for the delay value minus how long this takes
-    timeStart = time.perf_counter()
-    epd.prepare()
+        # can't get past this
+        sys.exit(1)
 
-    if args.random_frames:
-        currentFrame = random.randint(0, videoInfo["frame_count"])
 
-    msTimecode = f"{int(currentFrame * videoInfo['frame_time'])}ms"
+# The display driver called `name`. If it's been loaded before with the same omni-epd settings, its
+# size and mode from then are used straight away while the driver loads in the background, so the
+# first frame can be rendered in the meantime
+def open_display(name):
+    cached = cached_display(name)
+    if cached:
+        return PendingDisplay(name, cached)
+    display = load_display(name)
+    save_display(name, display)
+    return display
 
-    # Use ffmpeg to extract a frame from the movie, letterbox/pillarbox it, and put it in memory as frame.bmp
-    generate_frame(currentVideo, "/dev/shm/frame.bmp", msTimecode)
 
-    # Open frame.bmp in PIL
-    pil_im = Image.open("/dev/shm/frame.bmp")
+# Size and mode the display driver called `name` had when it was last loaded, if its omni-epd settings haven't changed since
+def cached_display(name):
+    try:
+        with open(displayCacheFile) as cache:
+            cached = json.load(cache).get(name)
+    except (OSError, ValueError, AttributeError):
+        cached = None
+    if cached and cached.get("settings") == display_settings(name):
+        return cached
+    return None
 
-    # Adjust contrast if specified
-    if args.contrast != 1:
-        enhancer = ImageEnhance.Contrast(pil_im)
-        pil_im = enhancer.enhance(args.contrast)
 
-    # Display the image
-    logger.debug(f"Displaying frame {int(currentFrame)} of {videoFilename} ({(currentFrame/videoInfo['frame_count'])*100:.1f}%)")
-    epd.display(pil_im)
+# For --optimize and --index, which can run alongside a player: the size and mode of the display
+# called `name` from when the player last loaded it, without touching the display itself. --index
+# doesn't need it, just to find the display's optimized copies
+def display_size(name, required=True):
+    cached = cached_display(name)
+    if not cached:
+        if required:
+            logger.error(f"The size of the {name} display isn't known yet, play something on it first")
+            sys.exit(1)
+        logger.info(f"The size of the {name} display isn't known yet, so its optimized copies won't be indexed")
+        cached = {"width": 1, "height": 1, "mode": "bw"}
+    return DisplaySize(cached)
+
+
+# Settings in a display's omni-epd settings files that change images before they're displayed
+# (rotating, flipping, dithering and image enhancements), leaving out ones set to do nothing
+def display_transforms(name):
+    import configparser
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        config.read(["omni-epd.ini", f"{name}.ini"])
+    except configparser.Error:
+        # Can't tell, so assume there are some
+        return ["unreadable settings"]
+    transforms = []
+    for section in config.sections():
+        if section == "EPD":
+            continue
+        for key, value in config[section].items():
+            neutral = omniNeutralSettings.get(key)
+            try:
+                unchanged = neutral is not None and (value.strip().lower() == neutral or float(value) == float(neutral))
+            except ValueError:
+                unchanged = False
+            if not unchanged:
+                transforms.append(f"{key}={value}")
+    return transforms
 
-    # Increment the position
-    if args.random_frames:
-        if args.random_file:
-            # Pick a new random video
-            currentVideo = get_random_video(viddir)
-            videoFilename = os.path.basename(currentVideo)
-            videoInfo = video_info(currentVideo)
-    else:
-        currentFrame += args.increment
-        # If it's the end of the video
-        if currentFrame > videoInfo["frame_count"]:
-            if not args.loop:
-                if args.random_file:
-                    # Pick a new random video
-                    currentVideo = get_random_video(viddir)
-                else:
-                    # Update currently playing video to be the next one in the Videos directory
-                    currentVideo = get_next_video(viddir, videoFilename)
 
-                # Note new video in nowPlaying file
-                with open("nowPlaying", "w") as file:
-                    file.write(os.path.abspath(currentVideo))
+# Modification times of the omni-epd settings files for a display, which can change its size (e.g. rotation)
+def display_settings(name):
+    settings = {}
+    for filename in ("omni-epd.ini", f"{name}.ini"):
+        with contextlib.suppress(OSError):
+            settings[filename] = os.stat(filename).st_mtime
+    return settings
 
-                # Update videoFilepath for new video
-                videoFilename = os.path.basename(currentVideo)
-                # Update progressfile location
-                progressfile = os.path.join(progressdir, f"{videoFilename}.progress")
-                # Update video info for new video
-                videoInfo = video_info(currentVideo)
 
-            # Reset frame to 0 (this restarts the same video if looping)
-            currentFrame = 0
+displayCacheLock = threading.Lock()
+
+
+# Note the size and mode of a display driver, for open_display
+def save_display(name, display):
+    with displayCacheLock:
+        try:
+            with open(displayCacheFile) as cache:
+                displays = json.load(cache)
+        except (OSError, ValueError):
+            displays = {}
+        entry = {"width": display.width, "height": display.height, "mode": getattr(display, "mode", "bw"), "settings": display_settings(name)}
+        if displays.get(name) == entry:
+            return
+        displays[name] = entry
+        os.makedirs(os.path.dirname(displayCacheFile), exist_ok=True)
+        with open(f"{displayCacheFile}.tmp", "w") as cache:
+            json.dump(displays, cache)
+        os.replace(f"{displayCacheFile}.tmp", displayCacheFile)
+
+
+# Stands in for a display whose driver is loading in the background, with the size and mode it had
+# last time. Anything else waits for the driver to finish loading and comes from it
+class PendingDisplay:
+    def __init__(self, name, cached):
+        self.name = name
+        self.width = cached["width"]
+        self.height = cached["height"]
+        self.mode = cached["mode"]
+        self.loader = ThreadPoolExecutor(max_workers=1)
+        self.future = self.loader.submit(load_display, name)
+        self.driver = None
+
+    # Only called for attributes that aren't set above
+    def __getattr__(self, attr):
+        if attr in ("loader", "future", "driver"):
+            raise AttributeError(attr)
+        if self.driver is None:
+            display = self.future.result()
+            self.loader.shutdown()
+            save_display(self.name, display)
+            if (display.width, display.height, getattr(display, "mode", "bw")) != (self.width, self.height, self.mode):
+                # Frames have been rendered for the wrong size, start over now the right one is saved
+                logger.warning(f"The {self.name} display's size or mode has changed since it was last used, restarting")
+                os.execv(sys.executable, [sys.executable, os.path.abspath(__file__)] + sys.argv[1:])
+            self.driver = display
+        return getattr(self.driver, attr)
+
+
+# Stands in for a display when only its size and mode are needed. Shutting it down does nothing, so
+# the display is left to the player that's driving it
+class DisplaySize:
+    def __init__(self, cached):
+        self.width = cached["width"]
+        self.height = cached["height"]
+        self.mode = cached["mode"]
+
+    def prepare(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Parse the settings of each display in a --displays file: the options in its section on top of
+# slowmovie.conf, with the command line taking precedence over both
+def display_args(filename, argv=None):
+    import configparser
+    displays = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(filename) as file:
+            displays.read_file(file)
+    except (OSError, configparser.Error) as e:
+        logger.error(f"Couldn't read displays file '{filename}': {e}")
+        sys.exit(1)
+    if not displays.sections():
+        logger.error(f"No displays are set up in '{filename}'")
+        sys.exit(1)
+
+    defaults = ""
+    if os.path.isfile("slowmovie.conf"):
+        with open("slowmovie.conf") as file:
+            defaults = file.read()
+    for name in displays.sections():
+        options = "".join(f"{key} = {value}\n" for key, value in displays[name].items())
+        yield name, parser.parse_args(argv, config_file_contents=f"{defaults}\n{options}")
+
+
+# Set up and run the player(s). `argv` replaces the command line, `display` replaces the display driver
+# named by --epd, and `refreshes` stops playback after that many refreshes instead of running forever.
+# Returns the list of Players
+def main(argv=None, display=None, refreshes=None):
+    # Set up logging
+    fileHandler = logging.FileHandler("slowmovie.log")
+    fileHandler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)-8s: %(module)s : %(message)s"))
+    logger.addHandler(fileHandler)
+
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setFormatter(logging.Formatter("%(levelname)s:%(module)s:%(message)s"))
+    logger.addHandler(consoleHandler)
+
+    args = parser.parse_args(argv)
+
+    # Set log level
+    logger.setLevel(getattr(logging, args.loglevel))
+
+    # Set up e-Paper display(s) - do this first since we can't do much if it fails. --optimize and --index only need their sizes
+    if args.optimize:
+        opener = display_size
+    elif args.index:
+        opener = functools.partial(display_size, required=False)
+    else:
+        opener = open_display
+    pool = None
+    if args.displays:
+        # Each display gets its own state directory, and their frames are rendered by a shared pool of workers
+        pool = ThreadPoolExecutor(max_workers=args.workers)
+        players = []
+        for name, displayArgs in display_args(args.displays, argv):
+            statedir = os.path.join("progress", name)
+            players.append(Player(displayArgs, opener(displayArgs.epd), statedir, os.path.join(statedir, "nowPlaying"), name, pool))
+        logger.info(f"Driving {len(players)} displays: {', '.join(player.name for player in players)}")
+    else:
+        players = [Player(args, display or opener(args.epd))]
+
+    if args.prerender or args.optimize or args.index:
+        # Handle when the program is killed and exit gracefully
+        def exithandler(signum, frame):
+            logger.info("Exiting Program")
+            try:
+                for player in players:
+                    player.close(player.args.clear)
+            finally:
+                sys.exit()
+
+        # Add hooks for interrupt signal
+        signal.signal(signal.SIGTERM, exithandler)
+        signal.signal(signal.SIGINT, exithandler)
+
+        if args.optimize:
+            optimize_library(players)
+        if args.index:
+            index_library(players)
+            sys.exit()
+
+        for player in players:
+            if player.args.file:
+                videos = [player.args.file]
+            else:
+                videos = player.library.paths()
+            for video in videos:
+                player.prerender(video)
+        sys.exit()
 
-        # Log the new location in the proper progressfile
-        with open(progressfile, "w") as log:
-            log.write(str(currentFrame))
+    # Displays are refreshed one at a time, while the other players' next frames are rendered in the background
+    asyncio.run(play(players, refreshes))
+    if pool:
+        pool.shutdown()
+    return players
 
-    epd.sleep()
 
-    # Adjust sleep delay to account for the time since we started updating this frame.
-    timeDiff = time.perf_counter() - timeStart
-    time.sleep(max(args.delay - timeDiff, 0))
+if __name__ == "__main__":
+    # Move to the directory where this code is
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    main()